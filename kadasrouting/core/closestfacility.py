@@ -0,0 +1,186 @@
+import logging
+
+from qgis.core import QgsPointXY
+
+from kadasrouting.core.route import haversine
+from kadasrouting.utilities import transformToWGS
+from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.valhalla.config import ValhallaConfig
+from kadasrouting.valhalla.tasks import runMany, currentTask, checkCanceled
+
+LOG = logging.getLogger(__name__)
+
+TIME = "time"
+DISTANCE = "distance"
+
+# Used until the valhalla configuration has been rendered once
+DEFAULT_MAX_MATRIX_LOCATIONS = 50
+DEFAULT_MAX_MATRIX_DISTANCE = 200000.0
+
+
+def facilityPoints(layer):
+    """
+    Return the (feature id, QgsPointXY in EPSG:4326) of the point features
+    of a layer. Features without a geometry are skipped.
+    """
+    transformer = transformToWGS(layer.crs())
+    points = []
+    for feature in layer.getFeatures():
+        geom = feature.geometry()
+        if geom is None or geom.isEmpty():
+            continue
+        point = transformer.transform(QgsPointXY(geom.centroid().asPoint()))
+        points.append((feature.id(), point))
+    return points
+
+
+def matrixChunkSize(profile):
+    """
+    Number of targets sent in a single matrix request with one source,
+    so that the request stays within max_matrix_locations.
+    """
+    maxLocations = ValhallaConfig.getInstance().serviceLimit(
+        profile, "max_matrix_locations", DEFAULT_MAX_MATRIX_LOCATIONS
+    )
+    return max(1, int(maxLocations) - 1)
+
+
+def matrixMaxDistance(profile):
+    """
+    Straight-line distance in meters beyond which valhalla rejects a matrix
+    request, or None if there is no limit
+    """
+    maxDistance = ValhallaConfig.getInstance().serviceLimit(
+        profile, "max_matrix_distance", DEFAULT_MAX_MATRIX_DISTANCE
+    )
+    return float(maxDistance) if maxDistance else None
+
+
+def rankFacilities(origin, points, profile, costingOptions, metric=TIME, n=1):
+    """
+    Rank candidate points by travel time or distance from origin, using
+    sources_to_targets matrix requests.
+
+    :param origin: Origin in EPSG:4326
+    :type origin: QgsPointXY
+
+    :param points: Candidates in EPSG:4326
+    :type points: list
+
+    :param metric: TIME or DISTANCE
+    :type metric: str
+
+    :param n: Number of candidates to return
+    :type n: int
+
+    :returns: The n closest reachable candidates, as (index in points,
+        time in seconds, distance in km) tuples sorted by metric
+    :rtype: list
+    """
+    valhalla = ValhallaClient.getInstance()
+    # A single target beyond the matrix distance limit makes valhalla
+    # reject the whole request, these candidates cannot be ranked
+    maxDistance = matrixMaxDistance(profile)
+    candidates = [
+        i
+        for i, p in enumerate(points)
+        if maxDistance is None
+        or haversine(origin.x(), origin.y(), p.x(), p.y()) <= maxDistance
+    ]
+    if len(candidates) < len(points):
+        LOG.debug(
+            "Skipping %d facilities beyond %s m"
+            % (len(points) - len(candidates), maxDistance)
+        )
+    chunkSize = matrixChunkSize(profile)
+    chunks = [
+        candidates[i:i + chunkSize] for i in range(0, len(candidates), chunkSize)
+    ]
+    requests = [
+        ([origin], [points[i] for i in chunk], profile, costingOptions)
+        for chunk in chunks
+    ]
+    costs = []
+    errors = []
+    for chunkIndex, response, error in runMany(
+        valhalla.matrix, requests, task=currentTask()
+    ):
+        if error is not None:
+            # the other chunks can still be ranked
+            LOG.warning("Matrix request failed, skipping its facilities: %s" % error)
+            errors.append(error)
+            continue
+        chunk = chunks[chunkIndex]
+        for j, cost in enumerate(response["sources_to_targets"][0]):
+            if cost.get("time") is None:
+                continue
+            costs.append((chunk[j], cost["time"], cost["distance"]))
+    # runMany stops early when the task is canceled
+    checkCanceled()
+    if errors and len(errors) == len(chunks):
+        raise errors[0]
+    key = 1 if metric == TIME else 2
+    costs.sort(key=lambda cost: (cost[key], cost[0]))
+    return costs[:n]
+
+
+def closestFacilities(origin, points, n, profile, costingOptions, metric=TIME):
+    """
+    Find the n facilities closest to origin, and compute the route to each
+    of them. Only the winners of the matrix ranking are routed.
+
+    :param points: (feature id, QgsPointXY in EPSG:4326) of the
+        candidates, as returned by facilityPoints
+    :type points: list
+
+    :returns: One dict per facility, closest first, with the feature id,
+        point, time, distance and route response
+    :rtype: list
+    """
+    if not points:
+        return []
+    ranking = rankFacilities(
+        origin, [p for _, p in points], profile, costingOptions, metric, n
+    )
+    LOG.debug("Closest facilities: %s" % ranking)
+    valhalla = ValhallaClient.getInstance()
+    requests = [
+        ([origin, points[index][1]], profile, None, costingOptions)
+        for index, _, _ in ranking
+    ]
+    routes = {}
+    for i, response, error in runMany(valhalla.route, requests, task=currentTask()):
+        if error is not None:
+            raise error
+        routes[i] = response
+    checkCanceled()
+    return [
+        {
+            "feature": points[index][0],
+            "point": points[index][1],
+            "time": time,
+            "distance": distance,
+            "route": routes[i],
+        }
+        for i, (index, time, distance) in enumerate(ranking)
+    ]
+
+
+def closestFacilitiesAsync(origin, layer, n, profile, costingOptions, metric=TIME):
+    """
+    Same as closestFacilities for the point features of layer, computed in
+    the background. The layer is read in the calling thread.
+
+    :rtype: ValhallaTask
+    """
+    points = facilityPoints(layer)
+    return ValhallaClient.getInstance().runAsync(
+        "Closest facility",
+        closestFacilities,
+        origin,
+        points,
+        n,
+        profile,
+        costingOptions,
+        metric,
+    )
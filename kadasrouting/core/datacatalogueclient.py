@@ -9,11 +9,12 @@ from PyQt5.QtCore import QUrl, QFile, QDir, QUrlQuery, QEventLoop, Qt
 from PyQt5.QtNetwork import QNetworkRequest, QNetworkReply
 from PyQt5.QtWidgets import QProgressBar
 
-from qgis.core import QgsNetworkAccessManager, QgsFileDownloader, Qgis
+from qgis.core import QgsNetworkAccessManager, QgsFileDownloader, QgsSettings, Qgis
 from qgis.utils import iface
 
 from kadas.kadasgui import KadasPluginInterface
 from kadasrouting.utilities import appDataDir, waitcursor, pushWarning, tr
+from kadasrouting.core.tileextract import packTilesFolder
 
 LOG = logging.getLogger(__name__)
 
@@ -48,13 +49,21 @@ class DataCatalogueClient:
         self.downloader = None
 
     @staticmethod
-    def dataTimestamp(itemid):
+    def localMetadata(itemid):
         filename = os.path.join(
             DataCatalogueClient.folderForDataItem(itemid), "metadata"
         )
         try:
             with open(filename) as f:
-                timestamp = json.load(f)["modified"]
+                return json.load(f)
+        except Exception as e:
+            LOG.debug("metadata file is failed to read: %s" % e)
+            return None
+
+    @staticmethod
+    def dataTimestamp(itemid):
+        try:
+            timestamp = DataCatalogueClient.localMetadata(itemid)["modified"]
             LOG.debug("timestamp is %s" % timestamp)
             return timestamp
         except Exception as e:
@@ -127,8 +136,11 @@ class DataCatalogueClient:
 
     def install(self, data):
         itemid = data["id"]
+        DataCatalogueClient.releasePackage(itemid)
         self._downloadAndUnzip(itemid)
         if os.path.exists(self.folderForDataItem(itemid)):
+            if QgsSettings().value("/kadasrouting/buildTileExtract", False, type=bool):
+                self._buildTileExtract(itemid)
             filename = os.path.join(self.folderForDataItem(itemid), "metadata")
             LOG.debug("install data on %s" % filename)
             with open(filename, "w") as f:
@@ -137,6 +149,17 @@ class DataCatalogueClient:
         else:
             return False
 
+    @waitcursor
+    def _buildTileExtract(self, itemid):
+        """Pack the unzipped tiles into a single tar extract valhalla can mmap"""
+        try:
+            packTilesFolder(self.folderForDataItem(itemid))
+        except Exception as e:
+            LOG.warning("Could not build the tile extract for %s: %s" % (itemid, e))
+            pushWarning(
+                tr("Could not pack the map package, the unpacked tiles will be used")
+            )
+
     def update_progress(self, current, maximum):
         LOG.debug("Progress %s of %s" % (current, maximum))
         try:
@@ -201,8 +224,24 @@ class DataCatalogueClient:
     def uninstall(itemid):
         path = DataCatalogueClient.folderForDataItem(itemid)
         LOG.debug("uninstall/remove from %s" % path)
+        DataCatalogueClient.releasePackage(itemid)
         return QDir(DataCatalogueClient.folderForDataItem(itemid)).removeRecursively()
 
+    @staticmethod
+    def releasePackage(itemid):
+        """
+        Stop the long-lived valhalla processes if they use the package, so
+        that its files can be replaced or removed (open files cannot be on
+        Windows). They are started again by the next request.
+        """
+        if itemid != QgsSettings().value("/kadasrouting/activeValhallaTilesID"):
+            return
+        # Imported here, the valhalla package depends on this module
+        from kadasrouting.valhalla.client import ValhallaClient
+
+        LOG.debug("Releasing the active package %s" % itemid)
+        ValhallaClient.getInstance().shutdown()
+
     @staticmethod
     def folderForDataItem(itemid):
         return os.path.join(DataCatalogueClient.folderData(), itemid)
@@ -0,0 +1,144 @@
+import math
+import logging
+
+from qgis.core import QgsSettings
+
+from kadasrouting.core.route import EARTH_RADIUS, haversine
+
+LOG = logging.getLogger(__name__)
+
+# Gains of the filter: the fraction of the position error corrected at each
+# fix, and the fraction of it attributed to a change of velocity
+DEFAULT_ALPHA = 0.5
+DEFAULT_BETA = 0.1
+# Weight of the speed and direction reported by the receiver in the
+# velocity estimate
+VELOCITY_WEIGHT = 0.5
+# The filter starts over after a gap in seconds, or a jump in meters, larger
+# than these, instead of slowly catching up with the new position
+MAX_FIX_GAP = 10.0
+MAX_FIX_JUMP = 200.0
+# Speed in km/h below which the heading is not updated
+MIN_HEADING_SPEED = 3.6
+
+
+def gpsSmoothingEnabled():
+    return QgsSettings().value("/kadasrouting/gpsSmoothing", True, type=bool)
+
+
+class GpsFix:
+    """
+    A position, with the attributes of QgsGpsInformation used by navigation.
+
+    :param speed: Speed in km/h
+    :param direction: Heading in degrees clockwise from north
+    """
+
+    def __init__(self, longitude, latitude, speed, direction):
+        self.longitude = longitude
+        self.latitude = latitude
+        self.speed = speed
+        self.direction = direction
+
+
+class GpsFilter:
+    """
+    Alpha-beta filter over the position and velocity of the vehicle.
+
+    Positions are filtered in meters, in a local frame centered on the
+    first fix. The velocity reported by the receiver is blended with the
+    one estimated from the positions, so that the heading stays steady
+    when the positions are noisy.
+    """
+
+    def __init__(self, alpha=None, beta=None):
+        settings = QgsSettings()
+        self.alpha = (
+            alpha
+            if alpha is not None
+            else settings.value("/kadasrouting/gpsFilterAlpha", DEFAULT_ALPHA, type=float)
+        )
+        self.beta = (
+            beta
+            if beta is not None
+            else settings.value("/kadasrouting/gpsFilterBeta", DEFAULT_BETA, type=float)
+        )
+        self.reset()
+
+    def reset(self):
+        self.origin = None
+        self.state = None
+        self.lastTime = None
+        self.direction = 0.0
+
+    def update(self, gpsinfo, now):
+        """
+        Add the fix in gpsinfo, received at time now (in seconds), and return
+        the filtered one.
+
+        :rtype: GpsFix
+        """
+        if self.state is not None:
+            dt = now - self.lastTime
+            longitude, latitude = self._toLonLat(self.state[0], self.state[1])
+            jump = haversine(longitude, latitude, gpsinfo.longitude, gpsinfo.latitude)
+            if dt > MAX_FIX_GAP or jump > MAX_FIX_JUMP:
+                LOG.debug("Restarting GPS filter after %.1f s and %.0f m" % (dt, jump))
+                self.reset()
+        if self.state is None:
+            return self._start(gpsinfo, now)
+
+        dt = now - self.lastTime
+        if dt <= 0:
+            return self._fix()
+        self.lastTime = now
+        x, y, vx, vy = self.state
+        zx, zy = self._toLocal(gpsinfo.longitude, gpsinfo.latitude)
+        # predict, then correct with the measured position
+        x += vx * dt
+        y += vy * dt
+        rx = zx - x
+        ry = zy - y
+        x += self.alpha * rx
+        y += self.alpha * ry
+        vx += self.beta * rx / dt
+        vy += self.beta * ry / dt
+        mx, my = self._velocity(gpsinfo)
+        vx += VELOCITY_WEIGHT * (mx - vx)
+        vy += VELOCITY_WEIGHT * (my - vy)
+        self.state = (x, y, vx, vy)
+        return self._fix()
+
+    def _start(self, gpsinfo, now):
+        self.origin = (gpsinfo.longitude, gpsinfo.latitude)
+        self.lastTime = now
+        self.direction = gpsinfo.direction
+        vx, vy = self._velocity(gpsinfo)
+        self.state = (0.0, 0.0, vx, vy)
+        return self._fix()
+
+    def _fix(self):
+        x, y, vx, vy = self.state
+        longitude, latitude = self._toLonLat(x, y)
+        speed = math.hypot(vx, vy) * 3.6
+        if speed > MIN_HEADING_SPEED:
+            self.direction = math.degrees(math.atan2(vx, vy)) % 360
+        return GpsFix(longitude, latitude, speed, self.direction)
+
+    def _velocity(self, gpsinfo):
+        speed = max(0.0, gpsinfo.speed) / 3.6
+        direction = math.radians(gpsinfo.direction)
+        return speed * math.sin(direction), speed * math.cos(direction)
+
+    def _scale(self):
+        return math.radians(1) * EARTH_RADIUS, math.radians(1) * EARTH_RADIUS * math.cos(
+            math.radians(self.origin[1])
+        )
+
+    def _toLocal(self, longitude, latitude):
+        ky, kx = self._scale()
+        return (longitude - self.origin[0]) * kx, (latitude - self.origin[1]) * ky
+
+    def _toLonLat(self, x, y):
+        ky, kx = self._scale()
+        return self.origin[0] + x / kx, self.origin[1] + y / ky
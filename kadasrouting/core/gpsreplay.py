@@ -0,0 +1,209 @@
+"""
+Recorded GPS tracks, read as a sequence of fixes to replay them in
+navigation. NMEA (RMC sentences), GPX (track points) and CSV files are
+supported.
+"""
+
+import csv
+import math
+import logging
+import datetime
+import xml.etree.ElementTree as ET
+
+from kadasrouting.core.gpsfilter import GpsFix
+from kadasrouting.core.route import haversine
+
+LOG = logging.getLogger(__name__)
+
+KNOTS_TO_KMH = 1.852
+# Interval in seconds between fixes of a track without times
+DEFAULT_FIX_INTERVAL = 1.0
+
+CSV_LONGITUDE = ("lon", "longitude", "x")
+CSV_LATITUDE = ("lat", "latitude", "y")
+CSV_TIME = ("time", "timestamp", "t")
+CSV_SPEED = ("speed",)
+CSV_DIRECTION = ("direction", "course", "heading")
+
+
+class TrackFormatException(Exception):
+    pass
+
+
+def readTrack(path):
+    """
+    Read the fixes of a recorded track, with the speed and direction
+    computed from the positions where the file does not have them.
+
+    :param path: Path to a .nmea/.txt/.log, .gpx or .csv file
+    :type path: str
+
+    :returns: (time in seconds since the first fix, GpsFix) tuples
+    :rtype: list
+    """
+    extension = path.lower().rsplit(".", 1)[-1]
+    if extension == "gpx":
+        points = _readGpx(path)
+    elif extension == "csv":
+        points = _readCsv(path)
+    else:
+        points = _readNmea(path)
+    if not points:
+        raise TrackFormatException("No GPS fix found in %s" % path)
+    return _toFixes(points)
+
+
+def _toFixes(points):
+    """
+    Build the fixes from (time, longitude, latitude, speed, direction)
+    tuples, where time, speed and direction may be None.
+    """
+    if any(p[0] is None for p in points):
+        times = [i * DEFAULT_FIX_INTERVAL for i in range(len(points))]
+    else:
+        times = [p[0] for p in points]
+    start = times[0]
+    fixes = []
+    for i, (_, lon, lat, speed, direction) in enumerate(points):
+        if speed is None or direction is None:
+            # from the previous to the next fix
+            before = max(0, i - 1)
+            after = min(len(points) - 1, i + 1)
+            x1, y1 = points[before][1:3]
+            x2, y2 = points[after][1:3]
+            if speed is None:
+                elapsed = times[after] - times[before]
+                distance = haversine(x1, y1, x2, y2)
+                speed = distance / elapsed * 3.6 if elapsed > 0 else 0.0
+            if direction is None:
+                if (x1, y1) != (x2, y2):
+                    direction = bearing(x1, y1, x2, y2)
+                else:
+                    direction = fixes[-1][1].direction if fixes else 0.0
+        fixes.append((times[i] - start, GpsFix(lon, lat, speed, direction)))
+    return fixes
+
+
+def bearing(x1, y1, x2, y2):
+    """Initial bearing in degrees from the first lon/lat position to the second"""
+    x1, y1, x2, y2 = map(math.radians, (x1, y1, x2, y2))
+    dx = x2 - x1
+    y = math.sin(dx) * math.cos(y2)
+    x = math.cos(y1) * math.sin(y2) - math.sin(y1) * math.cos(y2) * math.cos(dx)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+def _parseTime(value):
+    """Seconds since the epoch, from a number or an ISO 8601 string"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    value = value.strip().replace("Z", "+00:00")
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def _readNmea(path):
+    points = []
+    with open(path, errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("$") or line[3:6] != "RMC":
+                continue
+            fields = line.split("*")[0].split(",")
+            try:
+                point = _parseRmc(fields)
+            except (IndexError, ValueError) as e:
+                LOG.debug("Skipping NMEA sentence %s: %s" % (line, e))
+                continue
+            if point is not None:
+                points.append(point)
+    return points
+
+
+def _parseRmc(fields):
+    # $xxRMC,hhmmss.ss,A,ddmm.mm,N,dddmm.mm,E,knots,course,ddmmyy,...
+    if fields[2] != "A":
+        return None
+    lat = _nmeaDegrees(fields[3], 2) * (-1 if fields[4] == "S" else 1)
+    lon = _nmeaDegrees(fields[5], 3) * (-1 if fields[6] == "W" else 1)
+    speed = float(fields[7]) * KNOTS_TO_KMH if fields[7] else None
+    direction = float(fields[8]) if fields[8] else None
+    moment = None
+    if fields[1] and fields[9]:
+        date = datetime.datetime.strptime(fields[9], "%d%m%y")
+        clock = fields[1]
+        seconds = int(clock[0:2]) * 3600 + int(clock[2:4]) * 60 + float(clock[4:])
+        moment = (
+            date.replace(tzinfo=datetime.timezone.utc).timestamp() + seconds
+        )
+    return moment, lon, lat, speed, direction
+
+
+def _nmeaDegrees(value, degreeDigits):
+    return float(value[:degreeDigits]) + float(value[degreeDigits:]) / 60
+
+
+def _readGpx(path):
+    try:
+        root = ET.parse(path).getroot()
+    except ET.ParseError as e:
+        raise TrackFormatException("Invalid GPX file %s: %s" % (path, e))
+    points = []
+    for element in root.iter():
+        if _localName(element.tag) not in ("trkpt", "rtept"):
+            continue
+        moment = None
+        for child in element:
+            if _localName(child.tag) == "time" and child.text:
+                moment = _parseTime(child.text)
+        points.append(
+            (moment, float(element.get("lon")), float(element.get("lat")), None, None)
+        )
+    return points
+
+
+def _localName(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _readCsv(path):
+    points = []
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+
+        def _column(names):
+            for name in names:
+                if name in columns:
+                    return columns[name]
+            return None
+
+        lonColumn = _column(CSV_LONGITUDE)
+        latColumn = _column(CSV_LATITUDE)
+        if lonColumn is None or latColumn is None:
+            raise TrackFormatException(
+                "CSV file %s needs longitude and latitude columns" % path
+            )
+        timeColumn = _column(CSV_TIME)
+        speedColumn = _column(CSV_SPEED)
+        directionColumn = _column(CSV_DIRECTION)
+        for row in reader:
+
+            def _value(column, parse=float):
+                value = row.get(column) if column is not None else None
+                return parse(value) if value not in (None, "") else None
+
+            points.append(
+                (
+                    _value(timeColumn, _parseTime),
+                    float(row[lonColumn]),
+                    float(row[latColumn]),
+                    _value(speedColumn),
+                    _value(directionColumn),
+                )
+            )
+    return points
@@ -4,7 +4,7 @@ import logging
 from PyQt5.QtCore import QTextCodec
 from PyQt5.QtGui import QColor
 
-from kadasrouting.utilities import waitcursor, tr
+from kadasrouting.utilities import pushWarning, tr
 
 from kadasrouting.valhalla.client import ValhallaClient
 
@@ -38,33 +38,94 @@ def getFeaturesFromResponse(response):
     return features
 
 
-@waitcursor
-def generateIsochrones(
-    point, profile, costingOptions, intervals, colors, basename, overwrite=True
-):
-    response = valhalla.isochrones(point, profile, costingOptions, intervals, colors)
-    features = getFeaturesFromResponse(response)
+def isochroneLayerNames(costingOptions, intervals, basename):
     if costingOptions.get("shortest"):
         suffix = "km"
     else:
         suffix = "min"
-    for interval, feature in zip(intervals[::-1], features):
+    return ["{} {} - {}".format(interval, suffix, basename) for interval in intervals]
+
+
+def centerLayerName(basename):
+    return tr("Center of {basename}").format(basename=basename)
+
+
+def checkOverwrite(layername, overwrite):
+    """Remove an existing layer with the given name, or raise OverwriteError
+    if overwrite is False"""
+    try:
+        # FIXME: we do not consider if there are several layers with the same name here
+        existinglayer = QgsProject.instance().mapLayersByName(layername)[0]
+        if overwrite:
+            QgsProject.instance().removeMapLayer(existinglayer.id())
+        else:
+            raise OverwriteError(
+                tr(
+                    "layer {layername} already exists and overwrite is {overwrite}"
+                ).format(layername=layername, overwrite=overwrite)
+            )
+    except IndexError:
+        LOG.debug("this layer was not found: {}".format(layername))
+
+
+def checkIsochronesOverwrite(costingOptions, intervals, basename):
+    """Raise OverwriteError if any of the isochrone layers already exists"""
+    layernames = isochroneLayerNames(costingOptions, intervals, basename)
+    layernames.append(centerLayerName(basename))
+    for layername in layernames:
+        checkOverwrite(layername, False)
+
+
+def generateIsochrones(
+    point, profile, costingOptions, intervals, colors, basename, overwrite=True
+):
+    """
+    Compute isochrones in the background and add them to the project when
+    they are ready.
+
+    OverwriteError is raised before computing anything if a layer would be
+    overwritten and overwrite is False. If such a layer is added while
+    computing, the task emits requestFailed with the OverwriteError.
+
+    :returns: The task computing the isochrones, use its requestFailed
+        signal to handle errors
+    :rtype: ValhallaTask
+    """
+    if not overwrite:
+        checkIsochronesOverwrite(costingOptions, intervals, basename)
+    if len(intervals) != len(colors):
+        pushWarning(
+            tr("The number of intervals and colors are different, using default color")
+        )
+    task = valhalla.isochronesAsync(point, profile, costingOptions, intervals, colors)
+
+    def _ready(response):
+        # Nothing catches an exception raised in a slot
+        try:
+            addIsochronesFromResponse(
+                response, point, costingOptions, intervals, basename, overwrite
+            )
+        except OverwriteError as e:
+            task.requestFailed.emit(e)
+
+    task.responseReady.connect(_ready)
+    return task
+
+
+def addIsochronesFromResponse(
+    response, point, costingOptions, intervals, basename, overwrite=True
+):
+    if not overwrite:
+        # Check all the layers before adding any
+        checkIsochronesOverwrite(costingOptions, intervals, basename)
+    features = getFeaturesFromResponse(response)
+    layernames = isochroneLayerNames(costingOptions, intervals, basename)
+    for interval, layername, feature in zip(
+        intervals[::-1], layernames[::-1], features
+    ):
         # FIXME: we should use the 'contour' property in the feature to be sure of the contour line that we are
         # drawing, but due to a bug in qgis json parser, this property appears to be always set to '0'
-        layername = "{} {} - {}".format(interval, suffix, basename)
-        try:
-            # FIXME: we do not consider if there are several layers with the same name here
-            existinglayer = QgsProject.instance().mapLayersByName(layername)[0]
-            if overwrite:
-                QgsProject.instance().removeMapLayer(existinglayer.id())
-            else:
-                raise OverwriteError(
-                    tr(
-                        "layer {layername} already exists and overwrite is {overwrite}"
-                    ).format(layername=layername, overwrite=overwrite)
-                )
-        except IndexError:
-            LOG.debug("this layer was not found: {}".format(layername))
+        checkOverwrite(layername, overwrite)
 
         layer = QgsVectorLayer(
             "Polygon?crs=epsg:4326&field=centerx:double&field=centery:double&field=interval:double",
@@ -88,21 +149,8 @@ def generateIsochrones(
         layer.setRenderer(renderer)
 
     # Add center of reachability
-    center_point_layer_name = tr("Center of {basename}").format(basename=basename)
-    try:
-        existinglayer = QgsProject.instance().mapLayersByName(center_point_layer_name)[
-            0
-        ]
-        if overwrite:
-            QgsProject.instance().removeMapLayer(existinglayer.id())
-        else:
-            raise OverwriteError(
-                tr(
-                    "layer {layername} already exists and overwrite is {overwrite}"
-                ).format(layername=center_point_layer_name, overwrite=overwrite)
-            )
-    except IndexError:
-        LOG.debug("this layer was not found: {}".format(center_point_layer_name))
+    center_point_layer_name = centerLayerName(basename)
+    checkOverwrite(center_point_layer_name, overwrite)
 
     center_point = QgsVectorLayer(
         "Point?crs=epsg:4326",
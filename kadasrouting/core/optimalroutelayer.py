@@ -3,7 +3,7 @@ import json
 import logging
 import datetime
 
-from PyQt5.QtCore import QTimer, pyqtSignal, Qt
+from PyQt5.QtCore import pyqtSignal, Qt
 from PyQt5.QtGui import QColor, QPen, QBrush
 from PyQt5.QtWidgets import QAction
 
@@ -11,14 +11,14 @@ from kadas.kadasgui import KadasPinItem, KadasItemPos, KadasItemLayer, KadasGpxR
 
 from kadasrouting.utilities import (
     iconPath,
-    waitcursor,
     pushWarning,
-    decodePolyline6,
     formatdist,
     write_response
 )
 
 from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.core.routescheduler import RouteRequestScheduler
+from kadasrouting.core.route import Route, RouteTracker
 
 from qgis.core import (
     QgsProject,
@@ -39,6 +39,12 @@ LOG = logging.getLogger(__name__)
 
 MAX_DISTANCE_FOR_NAVIGATION = 30
 
+# Time without pin edits before the route is recomputed, in milliseconds
+PIN_EDIT_DELAY = 300
+
+# Line color: 005EFF
+ROUTE_COLOR = QColor(0, 94, 255)
+
 _icon_for_maneuver = {
     1: "direction_depart",
     2: "direction_depart_right",
@@ -111,16 +117,24 @@ class OptimalRouteLayer(KadasItemLayer):
             OptimalRouteLayer.LAYER_TYPE,
         )
         self.geom = None
+        self.route = None
+        self.tracker = None
+        self._distanceArea = None
         self.response = None
         self.points = []
         self.pins = []
         self.profile = None
         self.costingOptions = {}
+        self.avoidPolygons = None
+        self.patrolPolygons = None
+        # Read from a project that did not store the patrol areas, so it
+        # may be a patrol route
+        self.patrolUnknown = False
+        # Index of the leg the vehicle was last matched on
+        self.currentLeg = 0
         self.lineItem = None
         self.valhalla = ValhallaClient.getInstance()
-        self.timer = QTimer()
-        self.timer.setSingleShot(True)
-        self.timer.timeout.connect(self.updateFromPins)
+        self.scheduler = RouteRequestScheduler(PIN_EDIT_DELAY)
         self.actionAddAsRegularLayer = QAction(
             self.tr("Add to project as regular layer")
         )
@@ -134,83 +148,165 @@ class OptimalRouteLayer(KadasItemLayer):
         for itemId in items.keys():
             self.takeItem(itemId)
         self.pins = []
-        self.maneuvers = {}
+        self.route = None
+        self.tracker = None
 
     def hasRoute(self):
         return self.geom is not None
 
     def pinHasChanged(self):
-        self.timer.start(1000)
+        self.showPreview()
+        self.scheduler.schedule(self.updateFromPins)
+
+    def isComputing(self):
+        return self.scheduler.isBusy()
+
+    def cancelComputation(self):
+        self.scheduler.cancel()
+
+    def _startRouteTask(self, task, onResponse, onFailure):
+        """
+        Track the background computation of the route of this layer. A new
+        computation supersedes the one in progress, which is canceled.
+        """
+        self.scheduler.track(task)
+        task.responseReady.connect(onResponse)
+        task.requestFailed.connect(onFailure)
+        return task
+
+    def pinPoints(self):
+        return [QgsPointXY(pin.position()) for pin in self.pins]
+
+    def showPreview(self):
+        """
+        Show a dashed preview of the route through the current pin
+        positions, while the actual route is being computed. Legs whose
+        ends have not moved keep their routed geometry, the other ones are
+        drawn as straight lines.
+        """
+        if self.lineItem is None:
+            return
+        points = self.pinPoints()
+        legs = self.route.legs if self.route is not None else []
+        keepLegs = len(legs) == len(points) - 1 == len(self.points) - 1
+        vertices = []
+        for i in range(len(points) - 1):
+            if (
+                keepLegs
+                and points[i] == self.points[i]
+                and points[i + 1] == self.points[i + 1]
+            ):
+                vertices.extend(legs[i].points())
+            else:
+                vertices.extend([points[i], points[i + 1]])
+        if len(vertices) < 2:
+            return
+        self.lineItem.clear()
+        self.lineItem.addPartFromGeometry(
+            QgsGeometry.fromPolylineXY(vertices).constGet()
+        )
+        self.lineItem.setOutline(QPen(ROUTE_COLOR, 3, Qt.DashLine))
+        self.triggerRepaint()
 
-    @waitcursor
     def updateFromPins(self):
-        try:
-            for i, pin in enumerate(self.pins):
-                self.points[i] = QgsPointXY(pin.position())
-            response = self.valhalla.route(
-                self.points, self.profile, self.costingOptions
-            )
+        points = self.pinPoints()
+
+        def _apply(response):
+            self.points = points
             self.computeFromResponse(response)
             self.triggerRepaint()
-        except Exception as e:
+
+        def _failed(e):
             logging.error(e, exc_info=True)
             # TODO more fine-grained error control
             pushWarning(self.tr("Could not compute route"))
             logging.error("Could not compute route")
+            # Put the pins and the route back where they were
+            self.computeFromResponse(self.response)
+            self.triggerRepaint()
+
+        task = self.valhalla.routeAsync(
+            points, self.profile, self.avoidPolygons, self.costingOptions
+        )
+        return self._startRouteTask(task, _apply, _failed)
 
-    @waitcursor
     def updateFromPolyline(self, polyline, profile, costingOptions):
-        try:
-            response = self.valhalla.mapmatching(polyline, profile, costingOptions)
-            self.computeFromResponse(response)
-        except Exception as e:
+        def _failed(e):
             LOG.warning(e)
             pushWarning(self.tr("Could not compute route from polyline"))
 
-    @waitcursor
+        task = self.valhalla.mapmatchingAsync(polyline, profile, costingOptions)
+        return self._startRouteTask(task, self.computeFromResponse, _failed)
+
     def updateRoute(
-        self, points, profile, avoid_polygons, costingOptions, patrol_polygons=[]
+        self,
+        points,
+        profile,
+        avoid_polygons,
+        costingOptions,
+        patrol_polygons=[],
+        optimize=False,
     ):
-        try:
-            response = self.valhalla.route(
-                points, profile, avoid_polygons, costingOptions, patrol_polygons
-            )
+        """
+        Compute the route in the background and show it when it is ready.
+
+        If optimize is True, the intermediate points are visited in the
+        order that minimizes the travel cost, and the points of the layer
+        are stored in that order.
+
+        :returns: The task computing the route. Errors are pushed to the
+            message bar, except the Chinese Postman ones that are left to
+            the caller, through the task requestFailed signal.
+        :rtype: ValhallaTask
+        """
+
+        def _apply(response):
             # Write response to file
             write_response(response)
             self.costingOptions = costingOptions
             self.profile = profile
-            self.points = points
+            self.avoidPolygons = avoid_polygons
+            self.patrolPolygons = patrol_polygons or None
+            self.patrolUnknown = False
+            if optimize:
+                self.points = [
+                    points[i] for i in ValhallaClient.optimizedOrder(response)
+                ]
+            else:
+                self.points = points
             self.computeFromResponse(response)
             self.triggerRepaint()
-        except ValhallaException as e:
+
+        def _failed(e):
             LOG.error(e)
-            if "Failed to find a route between two locations for Chinese Postman route" in str(e):
-                raise(e)
-            else:
+            if not isinstance(e, ValhallaException) or (
+                "Failed to find a route between two locations for Chinese Postman route"
+                not in str(e)
+            ):
                 pushWarning(str(e))
 
+        if optimize:
+            task = self.valhalla.optimizedRouteAsync(
+                points, profile, avoid_polygons, costingOptions
+            )
+        else:
+            task = self.valhalla.routeAsync(
+                points, profile, avoid_polygons, costingOptions, patrol_polygons
+            )
+        return self._startRouteTask(task, _apply, _failed)
+
     def computeFromResponse(self, response):
         if response is None:
             return
         epsg4326 = QgsCoordinateReferenceSystem("EPSG:4326")
         self.clear()
         self.response = response
-        response_mini = response["trip"]
-        coordinates = []
-        self.duration = 0
-        self.distance = 0
-        for leg in response_mini["legs"]:
-            leg_coordinates = [
-                list(reversed(coord)) for coord in decodePolyline6(leg["shape"])
-            ]
-            coordinates.extend(leg_coordinates)
-            qgis_leg_coords = [QgsPointXY(x, y) for x, y in leg_coordinates]
-            geom = QgsGeometry.fromPolylineXY(qgis_leg_coords)
-            self.maneuvers[geom] = leg["maneuvers"]
-            self.duration += leg["summary"]["time"]
-            self.distance += round(leg["summary"]["length"], 3)
-        qgis_coords = [QgsPointXY(x, y) for x, y in coordinates]
-        self.geom = QgsGeometry.fromPolylineXY(qgis_coords)
+        self.route = Route(response)
+        self.tracker = RouteTracker(self.route, MAX_DISTANCE_FOR_NAVIGATION)
+        self.currentLeg = 0
+        self.duration = self.route.duration
+        self.distance = self.route.distance
+        self.geom = self.route.geometry()
         self.lineItem = KadasGpxRouteItem()
         self.lineItem.addPartFromGeometry(self.geom.constGet())
         self.lineItem.setName("route")
@@ -232,10 +328,8 @@ class OptimalRouteLayer(KadasItemLayer):
             formatted_minute=formatted_minute,
         )
         self.lineItem.setTooltip(tooltip)
-        # Line color: 005EFF
-        line_color = QColor(0, 94, 255)
-        self.lineItem.setOutline(QPen(line_color, 5))
-        self.lineItem.setFill(QBrush(line_color, Qt.SolidPattern))
+        self.lineItem.setOutline(QPen(ROUTE_COLOR, 5))
+        self.lineItem.setFill(QBrush(ROUTE_COLOR, Qt.SolidPattern))
 
         self.addItem(self.lineItem)
         for i, pt in enumerate(self.points):
@@ -256,105 +350,140 @@ class OptimalRouteLayer(KadasItemLayer):
             self.pins.append(pin)
             self.addItem(pin)
 
+    def distanceArea(self):
+        """The ellipsoidal calculator used for navigation, created once"""
+        if self._distanceArea is None:
+            self._distanceArea = QgsDistanceArea()
+            self._distanceArea.setSourceCrs(
+                QgsCoordinateReferenceSystem(4326),
+                QgsProject.instance().transformContext(),
+            )
+            self._distanceArea.setEllipsoid(
+                self._distanceArea.sourceCrs().ellipsoidAcronym()
+            )
+        return self._distanceArea
+
     def maneuverForPoint(self, pt, speed):
-        min_dist = MAX_DISTANCE_FOR_NAVIGATION
-        closest_leg = None
-        closest_segment = None
-        qgsdistance = QgsDistanceArea()
-        qgsdistance.setSourceCrs(
-            QgsCoordinateReferenceSystem(4326), QgsProject.instance().transformContext()
-        )
-        qgsdistance.setEllipsoid(qgsdistance.sourceCrs().ellipsoidAcronym())
+        qgsdistance = self.distanceArea()
+        closest = None
+        if self.tracker is not None:
+            closest = self.tracker.match(pt)
 
-        legs = list(self.maneuvers.keys())
-        for i, line in enumerate(legs):
-            _, _pt, segment, _ = line.closestSegmentWithContext(pt)
+        if closest is not None:
+            closest_leg, closest_segment, closest_point = closest
             dist = qgsdistance.convertLengthMeasurement(
-                qgsdistance.measureLine(pt, _pt), QgsUnitTypes.DistanceMeters
+                qgsdistance.measureLine(pt, closest_point), QgsUnitTypes.DistanceMeters
             )
-            if dist < min_dist:
-                closest_leg = line
-                closest_segment = segment
-                closest_point = _pt
-                min_dist = dist
-
-        if closest_leg is not None:
-            leg_points = closest_leg.asPolyline()
-            maneuvers = self.maneuvers[closest_leg]
-            for i, maneuver in enumerate(maneuvers[:-1]):
-                if (
-                    maneuver["begin_shape_index"] < closest_segment
-                    and maneuver["end_shape_index"] >= closest_segment
-                ):
-                    points = [closest_point]
-                    points.extend(
-                        leg_points[closest_segment: maneuver["end_shape_index"]]
-                    )
-                    distance_to_next = qgsdistance.convertLengthMeasurement(
-                        qgsdistance.measureLine(points), QgsUnitTypes.DistanceMeters
-                    )
-
-                    message = maneuvers[i + 1]["instruction"]
-                    if i == len(maneuvers) - 2:
-                        distance_to_next2 = None
-                        message2 = ""
-                        icon2 = _icon_path("transparentpixel")
-                    else:
-                        next_maneuver = maneuvers[i + 2]
-                        distance_to_next2 = maneuvers[i + 1]["length"] * 1000
-                        message2 = next_maneuver["instruction"]
-                        icon2 = icon_path_for_maneuver(maneuvers[i + 2]["type"])
-
-                    icon = icon_path_for_maneuver(maneuvers[i + 1]["type"])
+            i = closest_leg.maneuverIndexForSegment(closest_segment)
+            if dist < MAX_DISTANCE_FOR_NAVIGATION and i is not None:
+                self.currentLeg = closest_leg.index
+                maneuvers = closest_leg.maneuvers
+                maneuver = maneuvers[i]
+                position = closest_leg.distanceAt(closest_segment, closest_point)
+                distance_to_next = (
+                    closest_leg.distanceAtVertex(maneuver["end_shape_index"]) - position
+                )
 
+                message = maneuvers[i + 1]["instruction"]
+                if i == len(maneuvers) - 2:
+                    distance_to_next2 = None
+                    message2 = ""
+                    icon2 = _icon_path("transparentpixel")
+                else:
+                    next_maneuver = maneuvers[i + 2]
+                    distance_to_next2 = maneuvers[i + 1]["length"] * 1000
+                    message2 = next_maneuver["instruction"]
+                    icon2 = icon_path_for_maneuver(maneuvers[i + 2]["type"])
+
+                icon = icon_path_for_maneuver(maneuvers[i + 1]["type"])
+
+                if speed > 0:
                     time_to_next = distance_to_next / 1000 / speed * 3600
-                    try:
-                        maneuvers_ahead = maneuvers[i + 1:]
-                    except IndexError:
-                        maneuvers_ahead = []
-
-                    timeleft = time_to_next + sum([m["time"] for m in maneuvers_ahead])
-                    distanceleft = (
-                        distance_to_next
-                        + sum([m["length"] for m in maneuvers_ahead]) * 1000
-                    )
-
-                    delta = datetime.timedelta(seconds=timeleft)
-                    timeleft_string = ":".join(str(delta).split(":")[:-1])
-                    eta = datetime.datetime.now() + delta
-                    eta_string = eta.strftime("%H:%M")
-
-                    displayed_point = KadasCoordinateFormat.instance().getDisplayString(
-                        closest_point, QgsCoordinateReferenceSystem(4326)
-                    )
-                    if ", " not in displayed_point:
-                        displayed_point = displayed_point.replace(",", ", ")
-
-                    # Remove '.' character
-                    if message.endswith("."):
-                        message = message[:-1]
-                    if message2.endswith("."):
-                        message2 = message2[:-1]
-
-                    maneuver = dict(
-                        dist=formatdist(distance_to_next),
-                        message=message,
-                        icon=icon,
-                        dist2=formatdist(distance_to_next2),
-                        message2=message2,
-                        icon2=icon2,
-                        speed=speed,
-                        timeleft=timeleft_string,
-                        distleft=formatdist(distanceleft),
-                        raw_distleft=distanceleft,
-                        eta=eta_string,
-                        displayed_point=displayed_point,
-                        closest_point=closest_point,
-                    )
-                    return maneuver
+                else:
+                    time_to_next = closest_leg.timeAtVertex(
+                        maneuver["end_shape_index"]
+                    ) - closest_leg.timeAt(closest_segment, closest_point)
+                time_ahead, distance_ahead = closest_leg.remainingFrom(i + 1)
+                timeleft = time_to_next + time_ahead
+                distanceleft = distance_to_next + distance_ahead
+
+                delta = datetime.timedelta(seconds=timeleft)
+                timeleft_string = ":".join(str(delta).split(":")[:-1])
+                eta = datetime.datetime.now() + delta
+                eta_string = eta.strftime("%H:%M")
+
+                displayed_point = KadasCoordinateFormat.instance().getDisplayString(
+                    closest_point, QgsCoordinateReferenceSystem(4326)
+                )
+                if ", " not in displayed_point:
+                    displayed_point = displayed_point.replace(",", ", ")
+
+                # Remove '.' character
+                if message.endswith("."):
+                    message = message[:-1]
+                if message2.endswith("."):
+                    message2 = message2[:-1]
+
+                maneuver = dict(
+                    dist=formatdist(distance_to_next),
+                    raw_dist=distance_to_next,
+                    message=message,
+                    icon=icon,
+                    dist2=formatdist(distance_to_next2),
+                    message2=message2,
+                    icon2=icon2,
+                    speed=speed,
+                    timeleft=timeleft_string,
+                    distleft=formatdist(distanceleft),
+                    raw_distleft=distanceleft,
+                    eta=eta_string,
+                    displayed_point=displayed_point,
+                    closest_point=closest_point,
+                )
+                return maneuver
 
         raise NotInRouteException()
 
+    def canReroute(self):
+        """
+        Whether the route can be recomputed from another position. Routes
+        matched from a polyline and patrol routes cannot, nor routes read
+        from older projects, which may be patrol routes.
+        """
+        return (
+            self.hasRoute()
+            and self.profile is not None
+            and len(self.points) >= 2
+            and not self.patrolPolygons
+            and not self.patrolUnknown
+        )
+
+    def reroute(self, position):
+        """
+        Compute in the background a new route from position through the
+        route points not reached yet, with the same vehicle options and
+        areas to avoid. The current route is kept until the new one is
+        ready.
+
+        :type position: QgsPointXY
+        :rtype: ValhallaTask
+        """
+        remaining = self.points[self.currentLeg + 1:]
+        points = [QgsPointXY(position)] + remaining
+
+        def _apply(response):
+            self.points = points
+            self.computeFromResponse(response)
+            self.triggerRepaint()
+
+        def _failed(e):
+            LOG.warning("Could not compute a new route: %s" % e)
+
+        task = self.valhalla.routeAsync(
+            points, self.profile, self.avoidPolygons, self.costingOptions
+        )
+        return self._startRouteTask(task, _apply, _failed)
+
     def layerTypeKey(self):
         return OptimalRouteLayer.LAYER_TYPE
 
@@ -364,7 +493,11 @@ class OptimalRouteLayer(KadasItemLayer):
         points = json.loads(element.attribute("points"))
         self.points = [QgsGeometry.fromWkt(wkt).asPoint() for wkt in points]
         self.costingOptions = json.loads(element.attribute("costingOptions"))
-        self.profile = element.attribute("profile")
+        # Older projects have no profile for routes matched from a polyline
+        self.profile = element.attribute("profile") or None
+        self.avoidPolygons = json.loads(element.attribute("avoidPolygons", "null"))
+        self.patrolPolygons = json.loads(element.attribute("patrolPolygons", "null"))
+        self.patrolUnknown = not element.hasAttribute("patrolPolygons")
         self.computeFromResponse(response)
         return True
 
@@ -376,8 +509,10 @@ class OptimalRouteLayer(KadasItemLayer):
         element.setAttribute("name", self.layerTypeKey())
         element.setAttribute("response", json.dumps(self.response))
         element.setAttribute("points", json.dumps([pt.asWkt() for pt in self.points]))
-        element.setAttribute("profile", self.profile)
+        element.setAttribute("profile", self.profile or "")
         element.setAttribute("costingOptions", json.dumps(self.costingOptions))
+        element.setAttribute("avoidPolygons", json.dumps(self.avoidPolygons))
+        element.setAttribute("patrolPolygons", json.dumps(self.patrolPolygons))
         return True
 
     def addAsRegularLayer(self):
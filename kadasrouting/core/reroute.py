@@ -0,0 +1,72 @@
+import logging
+
+from qgis.core import QgsSettings
+
+from kadasrouting.core.route import haversine
+
+LOG = logging.getLogger(__name__)
+
+# Distance in meters from the last position on the route, and time in
+# seconds off the route, before a new route is computed
+DEFAULT_REROUTE_DISTANCE = 50
+DEFAULT_REROUTE_DELAY = 5
+
+
+def autoRerouteEnabled():
+    return QgsSettings().value("/kadasrouting/autoReroute", True, type=bool)
+
+
+class RerouteTrigger:
+    """
+    Decides when a vehicle that left its route needs a new one.
+
+    A reroute is triggered only once the vehicle has been off the route for
+    `delay` seconds and is more than `distance` meters away from the last
+    position where it was on it, so that GPS noise or a short detour do not
+    start a computation.
+    """
+
+    def __init__(self, distance=None, delay=None):
+        settings = QgsSettings()
+        self.distance = (
+            distance
+            if distance is not None
+            else settings.value(
+                "/kadasrouting/rerouteDistance", DEFAULT_REROUTE_DISTANCE, type=float
+            )
+        )
+        self.delay = (
+            delay
+            if delay is not None
+            else settings.value(
+                "/kadasrouting/rerouteDelay", DEFAULT_REROUTE_DELAY, type=float
+            )
+        )
+        self.reset()
+
+    def reset(self):
+        self.lastOnRoute = None
+        self.offRouteSince = None
+
+    def onRoute(self, point):
+        self.lastOnRoute = point
+        self.offRouteSince = None
+
+    def offRoute(self, point, now):
+        """
+        Record an off-route fix at time now (in seconds) and return True if
+        a new route must be computed. The delay starts over after a trigger.
+        """
+        if self.offRouteSince is None:
+            self.offRouteSince = now
+        if now - self.offRouteSince < self.delay:
+            return False
+        if self.lastOnRoute is not None:
+            distance = haversine(
+                self.lastOnRoute.x(), self.lastOnRoute.y(), point.x(), point.y()
+            )
+            if distance < self.distance:
+                return False
+        LOG.debug("Off the route since %.1f s, rerouting" % (now - self.offRouteSince))
+        self.offRouteSince = now
+        return True
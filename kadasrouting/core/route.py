@@ -0,0 +1,485 @@
+import math
+import logging
+from bisect import bisect_left, bisect_right
+
+from qgis.core import QgsPointXY
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from kadasrouting.utilities import (
+    decodePolyline6Arrays,
+    concatenateArrays,
+    lineGeometryFromArrays,
+)
+
+LOG = logging.getLogger(__name__)
+
+# Approximate length of a degree of latitude, in meters
+METERS_PER_DEGREE = 111320.0
+# Mean earth radius, in meters
+EARTH_RADIUS = 6371008.8
+
+# Segments searched before and after the last match when tracking. The
+# windows ahead are tried in turn, the closest segments first
+TRACKING_WINDOW_BEHIND = 5
+TRACKING_WINDOWS_AHEAD = (10, 50)
+# Distance between two fixes, in meters, above which the tracker searches
+# the whole route again
+TRACKING_JUMP_DISTANCE = 200
+
+
+class RouteLeg:
+    """
+    A leg of a Route, between two consecutive route points. It holds no
+    coordinates, but the range of its vertices in the route buffers. Shape
+    indices of its maneuvers are relative to the start of the leg.
+    """
+
+    def __init__(self, route, index, start, end, leg):
+        self.route = route
+        self.index = index
+        self.start = start
+        self.end = end
+        self.maneuvers = leg["maneuvers"]
+        self.maneuverBegins = [m["begin_shape_index"] for m in self.maneuvers]
+        # Time (s) and length (m) from the start of each maneuver to the end
+        # of the leg, plus a last 0 entry
+        self.suffixTimes = [0.0]
+        self.suffixLengths = [0.0]
+        for m in reversed(self.maneuvers):
+            self.suffixTimes.insert(0, self.suffixTimes[0] + m["time"])
+            self.suffixLengths.insert(0, self.suffixLengths[0] + m["length"] * 1000)
+        self.duration = leg["summary"]["time"]
+        self.length = leg["summary"]["length"]
+        self._geometry = None
+
+    def vertexCount(self):
+        return self.end - self.start
+
+    def point(self, i):
+        return QgsPointXY(self.route.xs[self.start + i], self.route.ys[self.start + i])
+
+    def points(self, first=0, last=None):
+        """The leg vertices from first to last (excluded) as QgsPointXY"""
+        last = self.vertexCount() if last is None else min(last, self.vertexCount())
+        xs, ys = self.route.xs, self.route.ys
+        return [
+            QgsPointXY(xs[i], ys[i]) for i in range(self.start + first, self.start + last)
+        ]
+
+    def maneuverIndexForSegment(self, segment):
+        """
+        Return the index of the maneuver covering a segment of the leg,
+        segment being the index of the vertex that ends it, or None if it is
+        past the last maneuver with a length.
+        """
+        i = bisect_left(self.maneuverBegins, segment) - 1
+        if 0 <= i < len(self.maneuvers) - 1 and segment <= self.maneuvers[i]["end_shape_index"]:
+            return i
+        return None
+
+    def remainingFrom(self, maneuver):
+        """
+        Time in seconds and distance in meters from the start of a maneuver
+        to the end of the route, according to valhalla.
+        """
+        timeAfter, lengthAfter = self.route.remainingAfterLeg(self.index)
+        return (
+            self.suffixTimes[maneuver] + timeAfter,
+            self.suffixLengths[maneuver] + lengthAfter,
+        )
+
+    def distanceAtVertex(self, i):
+        """Distance in meters along the route at a vertex of the leg"""
+        return self.route.cumulativeDistances()[self.start + i]
+
+    def timeAtVertex(self, i):
+        """Travel time in seconds along the route at a vertex of the leg"""
+        return self.route.cumulativeTimes()[self.start + i]
+
+    def _fraction(self, segment, pt):
+        """Position of pt on a segment, between 0 and 1"""
+        length = self.distanceAtVertex(segment) - self.distanceAtVertex(segment - 1)
+        if length <= 0:
+            return 0.0
+        previous = self.point(segment - 1)
+        partial = haversine(previous.x(), previous.y(), pt.x(), pt.y())
+        return min(partial / length, 1.0)
+
+    def distanceAt(self, segment, pt):
+        """
+        Distance in meters along the route at a point of a segment, segment
+        being the index of the vertex that ends it.
+        """
+        start = self.distanceAtVertex(segment - 1)
+        end = self.distanceAtVertex(segment)
+        return start + (end - start) * self._fraction(segment, pt)
+
+    def timeAt(self, segment, pt):
+        """Same as distanceAt, for the travel time in seconds"""
+        start = self.timeAtVertex(segment - 1)
+        end = self.timeAtVertex(segment)
+        return start + (end - start) * self._fraction(segment, pt)
+
+    def geometry(self):
+        """The leg as a line geometry, built on first use"""
+        if self._geometry is None:
+            self._geometry = lineGeometryFromArrays(
+                self.route.xs[self.start:self.end], self.route.ys[self.start:self.end]
+            )
+        return self._geometry
+
+
+class Route:
+    """
+    Geometry and maneuvers of a valhalla route response.
+
+    The vertices of all the legs are decoded once into a single pair of
+    lon/lat buffers, and each leg refers to its range in them.
+    """
+
+    def __init__(self, response):
+        trip = response["trip"]
+        lons = []
+        lats = []
+        self.legs = []
+        self.duration = 0
+        self.distance = 0
+        start = 0
+        for leg in trip["legs"]:
+            legLons, legLats = decodePolyline6Arrays(leg["shape"])
+            lons.append(legLons)
+            lats.append(legLats)
+            end = start + len(legLons)
+            self.legs.append(RouteLeg(self, len(self.legs), start, end, leg))
+            self.duration += leg["summary"]["time"]
+            self.distance += round(leg["summary"]["length"], 3)
+            start = end
+        self.xs = concatenateArrays(lons)
+        self.ys = concatenateArrays(lats)
+        self.legStarts = [leg.start for leg in self.legs]
+        # Segments from the last vertex of a leg to the first of the next one
+        self.legJoints = {leg.end - 1 for leg in self.legs}
+        self._geometry = None
+        self._segmentIndex = None
+        self._cumulativeDistances = None
+        self._cumulativeTimes = None
+        self._remainingAfterLeg = []
+        timeAfter = lengthAfter = 0.0
+        for leg in reversed(self.legs):
+            self._remainingAfterLeg.insert(0, (timeAfter, lengthAfter))
+            timeAfter += leg.duration
+            lengthAfter += leg.length * 1000
+
+    def vertexCount(self):
+        return len(self.xs)
+
+    def geometry(self):
+        """The whole route as a line geometry, built on first use"""
+        if self._geometry is None:
+            self._geometry = lineGeometryFromArrays(self.xs, self.ys)
+        return self._geometry
+
+    def remainingAfterLeg(self, index):
+        """Time (s) and length (m) of the legs after a leg"""
+        return self._remainingAfterLeg[index]
+
+    def cumulativeDistances(self):
+        """
+        Distance in meters along the route at each vertex, built on first
+        use. Legs are joined without adding any distance.
+        """
+        if self._cumulativeDistances is None:
+            lengths = segmentLengths(self.xs, self.ys)
+            for leg in self.legs[:-1]:
+                lengths[leg.end - 1] = 0.0
+            if numpy is not None:
+                self._cumulativeDistances = numpy.concatenate(
+                    ([0.0], numpy.cumsum(lengths))
+                )
+            else:
+                self._cumulativeDistances = [0.0]
+                for length in lengths:
+                    self._cumulativeDistances.append(
+                        self._cumulativeDistances[-1] + length
+                    )
+        return self._cumulativeDistances
+
+    def cumulativeTimes(self):
+        """
+        Travel time in seconds along the route at each vertex, built on
+        first use. The time of each maneuver is spread over its vertices in
+        proportion of the distance.
+        """
+        if self._cumulativeTimes is None:
+            distances = self.cumulativeDistances()
+            times = [0.0] * self.vertexCount()
+            elapsed = 0.0
+            for leg in self.legs:
+                for m in leg.maneuvers:
+                    first = leg.start + m["begin_shape_index"]
+                    last = leg.start + m["end_shape_index"]
+                    length = distances[last] - distances[first]
+                    for i in range(first, last + 1):
+                        if length > 0:
+                            fraction = (distances[i] - distances[first]) / length
+                        else:
+                            fraction = 1.0
+                        times[i] = elapsed + m["time"] * fraction
+                    elapsed += m["time"]
+            self._cumulativeTimes = times
+        return self._cumulativeTimes
+
+    def legForVertex(self, i):
+        return self.legs[bisect_right(self.legStarts, i) - 1]
+
+    def segmentIndex(self):
+        """The spatial index of the route segments, built on first use"""
+        if self._segmentIndex is None:
+            self._segmentIndex = SegmentIndex(self)
+        return self._segmentIndex
+
+    def closestPoint(self, pt, maxDistance):
+        """
+        Return the closest point of the route to pt, as a (leg, segment,
+        point) tuple, segment being the index in the leg of the vertex that
+        ends the closest segment. None is returned if the route is farther
+        than about maxDistance meters.
+
+        :type pt: QgsPointXY
+        :type maxDistance: float
+        """
+        found = self.segmentIndex().nearest(pt.x(), pt.y(), maxDistance)
+        return self.locateSegment(found)
+
+    def locateSegment(self, found):
+        """
+        Convert a (segment, x, y) tuple from SegmentIndex.nearest to the
+        (leg, segment in leg, point) tuple returned by closestPoint.
+        """
+        if found is None:
+            return None
+        i, x, y = found
+        leg = self.legForVertex(i)
+        return leg, i - leg.start + 1, QgsPointXY(x, y)
+
+    def segmentsBetween(self, first, last):
+        """The indexed segments from first to last (excluded)"""
+        first = max(first, 0)
+        last = min(last, self.vertexCount() - 1)
+        return [i for i in range(first, last) if i not in self.legJoints]
+
+
+def haversine(x1, y1, x2, y2):
+    """Great circle distance in meters between two lon/lat positions"""
+    x1, y1, x2, y2 = map(math.radians, (x1, y1, x2, y2))
+    h = (
+        math.sin((y2 - y1) / 2) ** 2
+        + math.cos(y1) * math.cos(y2) * math.sin((x2 - x1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(h, 1.0)))
+
+
+def segmentLengths(xs, ys):
+    """Length in meters of the segments between consecutive vertices"""
+    if numpy is not None:
+        x = numpy.radians(xs)
+        y = numpy.radians(ys)
+        h = (
+            numpy.sin(numpy.diff(y) / 2) ** 2
+            + numpy.cos(y[:-1]) * numpy.cos(y[1:]) * numpy.sin(numpy.diff(x) / 2) ** 2
+        )
+        return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.0)))
+    return [
+        haversine(xs[i], ys[i], xs[i + 1], ys[i + 1]) for i in range(len(xs) - 1)
+    ]
+
+
+class RouteTracker:
+    """
+    Follows a vehicle along a route from one GPS fix to the next.
+
+    The last matched segment is remembered, and the next fix is first
+    matched against windows of segments around it, mostly ahead. The
+    whole route is searched only if nothing in the window is close enough,
+    or if the fix jumped. This keeps the cost per fix constant, and avoids
+    snapping to another part of the route that runs nearby, e.g. when the
+    route doubles back.
+    """
+
+    def __init__(self, route, maxDistance):
+        self.route = route
+        self.maxDistance = maxDistance
+        self.reset()
+
+    def reset(self):
+        self.lastSegment = None
+        self.lastFix = None
+
+    def _jumped(self, pt):
+        if self.lastFix is None:
+            return True
+        scale = math.cos(math.radians(pt.y()))
+        dx = (pt.x() - self.lastFix.x()) * scale
+        dy = pt.y() - self.lastFix.y()
+        return math.hypot(dx, dy) * METERS_PER_DEGREE > TRACKING_JUMP_DISTANCE
+
+    def match(self, pt):
+        """
+        Return the position of pt on the route, as Route.closestPoint does.
+        """
+        index = self.route.segmentIndex()
+        found = None
+        if self.lastSegment is not None and not self._jumped(pt):
+            for ahead in TRACKING_WINDOWS_AHEAD:
+                window = self.route.segmentsBetween(
+                    self.lastSegment - TRACKING_WINDOW_BEHIND, self.lastSegment + ahead
+                )
+                found = index.nearest(pt.x(), pt.y(), self.maxDistance, window)
+                if found is not None:
+                    break
+        if found is None:
+            found = index.nearest(pt.x(), pt.y(), self.maxDistance)
+        self.lastSegment = found[0] if found is not None else None
+        self.lastFix = pt
+        return self.route.locateSegment(found)
+
+
+class SegmentIndex:
+    """
+    Uniform grid over the segments of a route, to find the segment closest
+    to a point without visiting the whole route. A segment is identified by
+    the route index of its first vertex. Segments joining two legs are not
+    indexed.
+
+    Distances are computed in a local equirectangular projection, which is
+    accurate enough at the scale of a GPS fix.
+    """
+
+    def __init__(self, route):
+        # Plain floats are faster to read one by one than array items
+        self.xs = route.xs.tolist()
+        self.ys = route.ys.tolist()
+        segments = [i for leg in route.legs for i in range(leg.start, leg.end - 1)]
+        self.cells = {}
+        self.keys = None
+        if not segments:
+            self.cellSize = 1.0
+            return
+        xmin, xmax = min(self.xs), max(self.xs)
+        ymin, ymax = min(self.ys), max(self.ys)
+        extent = max(xmax - xmin, ymax - ymin, 1e-6)
+        # About one segment per cell on average
+        self.cellSize = extent / math.sqrt(len(segments))
+        if numpy is not None:
+            self._buildArrays(segments)
+        else:
+            self._buildCells(segments)
+        LOG.debug("Route segment index: %d segments" % len(segments))
+
+    def _cell(self, value):
+        return int(math.floor(value / self.cellSize))
+
+    def _buildCells(self, segments):
+        for i in segments:
+            x0, x1 = sorted((self.xs[i], self.xs[i + 1]))
+            y0, y1 = sorted((self.ys[i], self.ys[i + 1]))
+            for cx in range(self._cell(x0), self._cell(x1) + 1):
+                for cy in range(self._cell(y0), self._cell(y1) + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+    def _buildArrays(self, segments):
+        """
+        Same grid as _buildCells, stored as (cell key, segment) pairs sorted
+        by key, where the key of a cell is cx * rows + cy. The cells of a
+        column are then contiguous.
+        """
+        segments = numpy.array(segments)
+        xs = numpy.array(self.xs)
+        ys = numpy.array(self.ys)
+        cx0, cx1 = [
+            numpy.floor(v / self.cellSize).astype(numpy.int64)
+            for v in (
+                numpy.minimum(xs[segments], xs[segments + 1]),
+                numpy.maximum(xs[segments], xs[segments + 1]),
+            )
+        ]
+        cy0, cy1 = [
+            numpy.floor(v / self.cellSize).astype(numpy.int64)
+            for v in (
+                numpy.minimum(ys[segments], ys[segments + 1]),
+                numpy.maximum(ys[segments], ys[segments + 1]),
+            )
+        ]
+        # Expand each segment to all the cells of its bounding box
+        nx = cx1 - cx0 + 1
+        counts = nx * (cy1 - cy0 + 1)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts
+        )
+        nx = numpy.repeat(nx, counts)
+        cx = numpy.repeat(cx0, counts) + offsets % nx
+        cy = numpy.repeat(cy0, counts) + offsets // nx
+        self.xOrigin = int(cx.min())
+        self.yOrigin = int(cy.min())
+        self.rows = int(cy.max()) - self.yOrigin + 1
+        keys = (cx - self.xOrigin) * self.rows + (cy - self.yOrigin)
+        order = numpy.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.segmentIds = numpy.repeat(segments, counts)[order]
+
+    def candidates(self, x, y, radius, radiusX):
+        cx0, cx1 = self._cell(x - radiusX), self._cell(x + radiusX)
+        cy0, cy1 = self._cell(y - radius), self._cell(y + radius)
+        if self.keys is None:
+            found = set()
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    found.update(self.cells.get((cx, cy), ()))
+            return found
+        cy0 = max(cy0, self.yOrigin)
+        cy1 = min(cy1, self.yOrigin + self.rows - 1)
+        found = set()
+        if cy0 > cy1:
+            return found
+        for cx in range(cx0, cx1 + 1):
+            column = (cx - self.xOrigin) * self.rows - self.yOrigin
+            first, last = numpy.searchsorted(
+                self.keys, (column + cy0, column + cy1 + 1)
+            )
+            found.update(self.segmentIds[first:last].tolist())
+        return found
+
+    def nearest(self, x, y, maxDistance, segments=None):
+        """
+        Return the closest segment to (x, y) within about maxDistance meters
+        as a (segment, closest x, closest y) tuple, or None.
+
+        :param segments: Segments to consider, the ones of the cells around
+            the point if None
+        """
+        radius = maxDistance / METERS_PER_DEGREE
+        scale = max(math.cos(math.radians(y)), 1e-6)
+        if segments is None:
+            segments = self.candidates(x, y, radius, radius / scale)
+        best = None
+        bestDistance = radius * radius
+        xs, ys = self.xs, self.ys
+        for i in segments:
+            ax, ay = (xs[i] - x) * scale, ys[i] - y
+            bx, by = (xs[i + 1] - x) * scale, ys[i + 1] - y
+            dx, dy = bx - ax, by - ay
+            length = dx * dx + dy * dy
+            t = 0.0 if length == 0 else max(0.0, min(1.0, -(ax * dx + ay * dy) / length))
+            px, py = ax + t * dx, ay + t * dy
+            distance = px * px + py * py
+            # Ties go to the first segment, as closestSegmentWithContext
+            if distance < bestDistance or (
+                distance == bestDistance and best is not None and i < best[0]
+            ):
+                bestDistance = distance
+                best = (i, x + px / scale, y + py)
+        return best
@@ -0,0 +1,88 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+from qgis.core import QgsSettings
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_ROUTES = 8
+# Total number of route vertices kept in memory by the cache
+DEFAULT_MAX_VERTICES = 2000000
+
+
+def geometryFingerprint(geom):
+    """Short digest of a geometry, computed from its WKB"""
+    return hashlib.blake2b(bytes(geom.asWkb()), digest_size=16).hexdigest()
+
+
+class RouteCache:
+    """
+    Least recently used cache of route layers, keyed by the fingerprint of
+    the geometry they were computed from.
+
+    The cache is bounded by a number of routes and by the total number of
+    vertices of their geometries. A route still being computed counts as
+    empty until it has one.
+    """
+
+    def __init__(self, maxRoutes=None, maxVertices=None):
+        settings = QgsSettings()
+        self.maxRoutes = (
+            maxRoutes
+            if maxRoutes is not None
+            else settings.value(
+                "/kadasrouting/routeCacheSize", DEFAULT_MAX_ROUTES, type=int
+            )
+        )
+        self.maxVertices = (
+            maxVertices
+            if maxVertices is not None
+            else settings.value(
+                "/kadasrouting/routeCacheVertices", DEFAULT_MAX_VERTICES, type=int
+            )
+        )
+        self.routes = OrderedDict()
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, key):
+        return key in self.routes
+
+    def get(self, key):
+        layer = self.routes.get(key)
+        if layer is not None:
+            self.routes.move_to_end(key)
+        return layer
+
+    def put(self, key, layer):
+        self.routes[key] = layer
+        self.routes.move_to_end(key)
+        self.prune()
+
+    def remove(self, key):
+        layer = self.routes.pop(key, None)
+        if layer is not None:
+            layer.cancelComputation()
+
+    def clear(self):
+        for key in list(self.routes):
+            self.remove(key)
+
+    def prune(self):
+        """Evict the least recently used routes until within the bounds"""
+        while len(self.routes) > 1 and (
+            len(self.routes) > self.maxRoutes
+            or self.vertexCount() > self.maxVertices
+        ):
+            key = next(iter(self.routes))
+            LOG.debug("Evicting cached route %s" % key)
+            self.remove(key)
+
+    def vertexCount(self):
+        return sum(
+            layer.route.vertexCount()
+            for layer in self.routes.values()
+            if layer.route is not None
+        )
@@ -0,0 +1,71 @@
+import logging
+
+from PyQt5.QtCore import QObject, QTimer
+
+LOG = logging.getLogger(__name__)
+
+
+class RouteRequestScheduler(QObject):
+    """
+    Schedules the background computations of one route.
+
+    Requests scheduled with schedule() are debounced: only the latest one
+    is started, once no new request has arrived for `delay` milliseconds.
+    Any new request supersedes the computation in progress, which is
+    canceled so its result is never applied.
+
+    A request is a callable returning the ValhallaTask computing it.
+    """
+
+    def __init__(self, delay, parent=None):
+        super().__init__(parent)
+        self.pending = None
+        self.task = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self._startPending)
+
+    def isBusy(self):
+        """True if a request is waiting to be started or being computed"""
+        return self.pending is not None or self.task is not None
+
+    def schedule(self, request):
+        self._cancelTask()
+        self.pending = request
+        self.timer.start()
+
+    def track(self, task):
+        """Make task the current computation, superseding any other one"""
+        self.timer.stop()
+        self.pending = None
+        self._cancelTask()
+        self.task = task
+
+        def _done():
+            if self.task is task:
+                self.task = None
+
+        task.responseReady.connect(_done)
+        task.requestFailed.connect(_done)
+        # A canceled task emits neither of them
+        task.taskCompleted.connect(_done)
+        task.taskTerminated.connect(_done)
+        return task
+
+    def cancel(self):
+        self.timer.stop()
+        self.pending = None
+        self._cancelTask()
+
+    def _cancelTask(self):
+        if self.task is not None:
+            LOG.debug("Canceling superseded route computation")
+            self.task.cancel()
+            self.task = None
+
+    def _startPending(self):
+        request, self.pending = self.pending, None
+        if request is not None:
+            # The request is expected to call track() with its task
+            request()
@@ -0,0 +1,115 @@
+import os
+import struct
+import shutil
+import logging
+import tarfile
+
+LOG = logging.getLogger(__name__)
+
+TILES_DIR_NAME = "valhalla_tiles"
+TILE_EXTRACT_NAME = "valhalla_tiles.tar"
+INDEX_FILE = "index.bin"
+# Valhalla index entry: offset of the tile data in the tar, graph id and size
+INDEX_ENTRY = struct.Struct("<QLL")
+
+
+def tileId(path):
+    """
+    Return the numeric graph id of a tile from its path relative to the
+    tiles directory, e.g. 2/000/818/660.gph
+    """
+    level, index = path[: -len(".gph")].split("/", 1)
+    return int(level) | (int(index.replace("/", "")) << 3)
+
+
+def tilePaths(tilesDir):
+    paths = []
+    for root, _, files in os.walk(tilesDir):
+        for name in files:
+            if not name.endswith(".gph"):
+                continue
+            path = os.path.relpath(os.path.join(root, name), tilesDir)
+            path = path.replace(os.sep, "/")
+            try:
+                tileId(path)
+            except ValueError:
+                LOG.debug("Skipping %s, it is not a valhalla tile" % path)
+                continue
+            paths.append(path)
+    return sorted(paths)
+
+
+def buildTileExtract(tilesDir, extractPath, progress=None):
+    """
+    Pack a valhalla tiles directory into one tar extract that valhalla can
+    memory-map.
+
+    The first member of the tar is an index.bin file with one entry per
+    tile, so valhalla can find the tiles without scanning the archive.
+
+    :param tilesDir: The unpacked valhalla tiles directory
+    :type tilesDir: str
+
+    :param extractPath: The path of the tar extract to create
+    :type extractPath: str
+
+    :param progress: Optional callable receiving (current, maximum)
+    :type progress: callable
+
+    :returns: The number of tiles packed
+    :rtype: int
+    """
+    paths = tilePaths(tilesDir)
+    tmpPath = extractPath + ".tmp"
+    with tarfile.open(tmpPath, "w", format=tarfile.USTAR_FORMAT) as tar:
+        # Reserve the index, it is filled once the tile offsets are known
+        index = tarfile.TarInfo(INDEX_FILE)
+        index.size = len(paths) * INDEX_ENTRY.size
+        tar.addfile(index, _Zeros(index.size))
+        for i, path in enumerate(paths):
+            tar.add(os.path.join(tilesDir, path), arcname=path, recursive=False)
+            if progress is not None:
+                progress(i + 1, len(paths))
+
+    entries = {}
+    indexOffset = None
+    with tarfile.open(tmpPath, "r") as tar:
+        for member in tar:
+            if member.name == INDEX_FILE:
+                indexOffset = member.offset_data
+            else:
+                entries[member.name] = INDEX_ENTRY.pack(
+                    member.offset_data, tileId(member.name), member.size
+                )
+    with open(tmpPath, "r+b") as f:
+        f.seek(indexOffset)
+        f.write(b"".join(entries[path] for path in paths))
+    os.replace(tmpPath, extractPath)
+    LOG.info("Packed %s tiles into %s" % (len(paths), extractPath))
+    return len(paths)
+
+
+def packTilesFolder(folder, removeTilesDir=True):
+    """
+    Build the tile extract of an installed map package folder and,
+    optionally, remove the unpacked tiles once the extract is complete.
+    """
+    tilesDir = os.path.join(folder, TILES_DIR_NAME)
+    extractPath = os.path.join(folder, TILE_EXTRACT_NAME)
+    buildTileExtract(tilesDir, extractPath)
+    if removeTilesDir:
+        shutil.rmtree(tilesDir, ignore_errors=True)
+    return extractPath
+
+
+class _Zeros:
+    """File-like object returning zero bytes, used to reserve the index"""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        self.remaining -= size
+        return b"\0" * size
@@ -0,0 +1,79 @@
+import logging
+
+from kadasrouting.core.route import haversine
+
+LOG = logging.getLogger(__name__)
+
+# Bounds, in seconds, of the interval between two navigation updates
+MIN_UPDATE_INTERVAL = 0.2
+MAX_UPDATE_INTERVAL = 2.0
+# Interval used when the vehicle is not moving
+IDLE_UPDATE_INTERVAL = 5.0
+# Fraction of the time left to the next maneuver between two updates
+MANEUVER_TIME_FRACTION = 0.1
+# Movement in meters and change of heading in degrees below which a fix
+# is considered to be the same position as the last update
+MIN_MOVE_DISTANCE = 2.0
+MIN_HEADING_CHANGE = 5.0
+# Speed in km/h below which the vehicle is considered to be standing still
+MIN_SPEED = 3.6
+
+
+class NavigationUpdateRate:
+    """
+    Decides which GPS fixes are worth a navigation update.
+
+    The interval between updates adapts to the speed and to the distance to
+    the next maneuver: updates are frequent when approaching a turn, and
+    sparse on long straight stretches or when standing still. Fixes that
+    neither moved nor turned the vehicle are skipped until the idle interval
+    has elapsed.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.lastTime = None
+        self.interval = MIN_UPDATE_INTERVAL
+
+    def isDue(self, gpsinfo, now):
+        """
+        Return True if the fix in gpsinfo, received at time now (in seconds),
+        needs a navigation update
+        """
+        if self.last is None:
+            return True
+        elapsed = now - self.lastTime
+        if elapsed < MIN_UPDATE_INTERVAL:
+            return False
+        longitude, latitude, direction = self.last
+        moved = haversine(longitude, latitude, gpsinfo.longitude, gpsinfo.latitude)
+        turned = abs((gpsinfo.direction - direction + 180) % 360 - 180)
+        if moved < MIN_MOVE_DISTANCE and turned < MIN_HEADING_CHANGE:
+            return elapsed >= IDLE_UPDATE_INTERVAL
+        return elapsed >= self.interval
+
+    def updated(self, gpsinfo, now, distanceToManeuver=None):
+        """
+        Record that a navigation update was done for gpsinfo, and adapt the
+        interval until the next one.
+
+        :param distanceToManeuver: Distance in meters to the next maneuver, or
+            None if not following a route
+        :type distanceToManeuver: float
+        """
+        self.last = (gpsinfo.longitude, gpsinfo.latitude, gpsinfo.direction)
+        self.lastTime = now
+        speed = gpsinfo.speed
+        if speed < MIN_SPEED:
+            self.interval = IDLE_UPDATE_INTERVAL
+        elif distanceToManeuver is None:
+            self.interval = MAX_UPDATE_INTERVAL
+        else:
+            timeToManeuver = distanceToManeuver / 1000 / speed * 3600
+            self.interval = min(
+                MAX_UPDATE_INTERVAL,
+                max(MIN_UPDATE_INTERVAL, timeToManeuver * MANEUVER_TIME_FRACTION),
+            )
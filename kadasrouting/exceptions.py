@@ -11,3 +11,9 @@ class Valhalla400Exception(ValhallaException):
     """Custom exception with detailed message from Valhalla"""
 
     pass
+
+
+class ValhallaCanceledException(ValhallaException):
+    """The request was canceled before valhalla answered"""
+
+    pass
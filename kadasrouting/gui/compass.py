@@ -0,0 +1,83 @@
+import logging
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPixmap, QTransform, QPainter
+
+from kadasrouting.utilities import iconPath
+
+LOG = logging.getLogger(__name__)
+
+# Number of rendered compass frames kept in memory
+COMPASS_CACHE_SIZE = 64
+# Change of heading or waypoint angle, in degrees, below which the compass
+# is not rendered again
+COMPASS_THRESHOLD = 1.0
+
+
+def _angleDelta(a, b):
+    return abs((a - b + 180) % 360 - 180)
+
+
+class CompassRenderer:
+    """
+    Renders the navigation compass: the compass rose rotated to the heading,
+    with the direction arrow pointing to the waypoint.
+
+    The images are loaded and scaled once. Frames are rendered for angles
+    rounded to the degree and kept in a small LRU cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.compassPixmap = QPixmap(iconPath("compass.png")).scaledToWidth(size)
+        self.bearingPixmap = QPixmap(iconPath("direction.png"))
+        self.frames = OrderedDict()
+        self.lastAngles = None
+
+    def reset(self):
+        self.lastAngles = None
+
+    def render(self, heading, wpangle):
+        """
+        Return the compass for a heading and a waypoint angle, in degrees,
+        or None if it has not changed enough since the last call to be
+        worth updating.
+
+        :rtype: QPixmap
+        """
+        if self.lastAngles is not None:
+            lastHeading, lastWpangle = self.lastAngles
+            if (
+                _angleDelta(heading, lastHeading) < COMPASS_THRESHOLD
+                and _angleDelta(wpangle, lastWpangle) < COMPASS_THRESHOLD
+            ):
+                return None
+        self.lastAngles = (heading, wpangle)
+        key = (round(heading) % 360, round(wpangle - heading) % 360)
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+        pixmap = self._renderFrame(*key)
+        self.frames[key] = pixmap
+        if len(self.frames) > COMPASS_CACHE_SIZE:
+            self.frames.popitem(last=False)
+        return pixmap
+
+    def _renderFrame(self, heading, bearing):
+        pixmap = QPixmap(self.size, self.size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        painter.setTransform(self._rotation(-heading))
+        painter.drawPixmap(0, 0, self.size, self.size, self.compassPixmap)
+        painter.setTransform(self._rotation(bearing))
+        painter.drawPixmap(0, 0, self.size, self.size, self.bearingPixmap)
+        painter.end()
+        return pixmap
+
+    def _rotation(self, angle):
+        transform = QTransform()
+        transform.translate(self.size / 2, self.size / 2)
+        transform.rotate(angle)
+        transform.translate(-self.size / 2, -self.size / 2)
+        return transform
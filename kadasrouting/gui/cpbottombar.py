@@ -172,18 +172,17 @@ class CPBottomBar(ValhallaRouteBottomBar, WIDGET):
         except TypeError:
             pushWarning(self.tr("Could not compute patrol: no polygon selected"))
             return
-        try:
-            layer.updateRoute(
-                points, profile, allAreasToAvoidWGS, costingOptions, allPatrolAreaWGS
-            )
-            self.btnNavigate.setEnabled(True)
-        except Exception as e:
-            if "Failed to find a route between two locations for Chinese Postman route" in str(e):
-                self.show_chinese_postman_warning(str(e))
-            else:
-                pushWarning(str(e))
-            LOG.error(e, exc_info=True)
-            LOG.error("Could not compute route")
+        task = layer.updateRoute(
+            points, profile, allAreasToAvoidWGS, costingOptions, allPatrolAreaWGS
+        )
+        task.responseReady.connect(self.routeComputed)
+        task.requestFailed.connect(self.routeFailed)
+
+    def routeFailed(self, e):
+        # Other errors are already pushed to the message bar by the layer
+        if "Failed to find a route between two locations for Chinese Postman route" in str(e):
+            self.show_chinese_postman_warning(str(e))
+        LOG.error("Could not compute route")
 
     def show_chinese_postman_warning(self, error_message):
         # Parse location for
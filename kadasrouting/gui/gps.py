@@ -1,17 +1,81 @@
 import logging
 
-from qgis.core import QgsApplication
+from PyQt5.QtCore import QObject, QTimer, QMetaMethod, pyqtSignal
 
-from kadasrouting.utilities import waitcursor
+from qgis.core import QgsApplication, QgsSettings
+
+from kadasrouting.core.gpsreplay import readTrack
+from kadasrouting.utilities import waitcursor, pushWarning, tr
 
 LOG = logging.getLogger(__name__)
 
 
 @waitcursor
 def getGpsConnection():
+    replayFile = QgsSettings().value("/kadasrouting/gpsReplayFile", "")
+    if replayFile:
+        speed = QgsSettings().value("/kadasrouting/gpsReplaySpeed", 1.0, type=float)
+        try:
+            return GpsReplaySource(replayFile, speed)
+        except Exception as e:
+            LOG.warning("Cannot replay GPS track {}: {}".format(replayFile, e))
+            pushWarning(tr("Cannot replay GPS track {}").format(replayFile))
+            return None
     gpsConnectionList = QgsApplication.gpsConnectionRegistry().connectionList()
     LOG.debug("gpsConnectionList = {}".format(gpsConnectionList))
     if len(gpsConnectionList) > 0:
         return gpsConnectionList[0]
     else:
         return None
+
+
+class GpsReplaySource(QObject):
+    """
+    Replays a recorded track as if it came from a GPS connection, with the
+    currentGPSInformation() method and stateChanged signal used by
+    navigation.
+
+    The track is played at `speed` times real time while stateChanged is
+    connected, and paused otherwise.
+    """
+
+    stateChanged = pyqtSignal(object)
+
+    def __init__(self, path, speed=1.0, loop=False, parent=None):
+        super().__init__(parent)
+        self.fixes = readTrack(path)
+        self.speed = max(speed, 0.001)
+        self.loop = loop
+        self.index = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._nextFix)
+        LOG.debug("Replaying %d GPS fixes from %s" % (len(self.fixes), path))
+
+    def currentGPSInformation(self):
+        return self.fixes[self.index][1]
+
+    def connectNotify(self, signal):
+        if signal == QMetaMethod.fromSignal(self.stateChanged):
+            if not self.timer.isActive():
+                self._scheduleNext()
+
+    def disconnectNotify(self, signal):
+        if not self.isSignalConnected(QMetaMethod.fromSignal(self.stateChanged)):
+            self.timer.stop()
+
+    def _scheduleNext(self):
+        if self.index + 1 < len(self.fixes):
+            interval = self.fixes[self.index + 1][0] - self.fixes[self.index][0]
+        elif self.loop:
+            interval = 0
+        else:
+            return
+        self.timer.start(int(max(0, interval) / self.speed * 1000))
+
+    def _nextFix(self):
+        self.index += 1
+        if self.index == len(self.fixes):
+            self.index = 0
+        self.stateChanged.emit(self.currentGPSInformation())
+        self._scheduleNext()
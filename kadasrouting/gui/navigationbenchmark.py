@@ -0,0 +1,203 @@
+"""
+Benchmark of the navigation update on a recorded GPS track.
+
+Run it from the KADAS python console, with the route to follow as the
+active layer:
+
+    from kadasrouting.gui.navigationbenchmark import runNavigationBenchmark
+    runNavigationBenchmark("/path/to/track.gpx")
+
+The track is replayed with GpsReplaySource into a NavigationPanel, fix by
+fix and as fast as possible, through the same slot as a live GPS. The panel
+runs on the recorded time of the fixes, so the update rate, smoothing and
+canvas throttling behave as on the road. It draws on an offscreen canvas,
+leaving the KADAS map untouched.
+
+The latency percentiles of each step are reported in milliseconds:
+maneuverForPoint, canvas recentre (refreshCanvas), HTML rendering of the
+instructions, map rendering after a recentre, and the whole tick.
+"""
+
+import json
+import math
+import time
+import logging
+
+from PyQt5.QtCore import QEventLoop, QTimer
+
+from qgis.utils import iface
+from qgis.core import QgsCoordinateReferenceSystem
+from qgis.gui import QgsMapCanvas
+
+from kadas.kadasgui import KadasPinItem
+
+from kadasrouting.core.optimalroutelayer import OptimalRouteLayer
+from kadasrouting.core.reroute import RerouteTrigger
+from kadasrouting.gui.gps import GpsReplaySource
+from kadasrouting.gui.navigationpanel import NavigationPanel
+
+LOG = logging.getLogger(__name__)
+
+BENCHMARK_PERCENTILES = [50, 90, 99]
+BENCHMARK_STEPS = ["maneuver", "canvas", "html", "render", "tick"]
+# The canvas starts rendering from a timer once refreshed, in milliseconds
+RENDER_START_DELAY_MS = 5
+
+
+def percentile(values, q):
+    """Nearest-rank percentile q (0-100) of values"""
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(q / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def offscreenCanvas():
+    """A hidden canvas with the size, CRS, extent and layers of the KADAS one"""
+    mapCanvas = iface.mapCanvas()
+    canvas = QgsMapCanvas()
+    canvas.resize(mapCanvas.size())
+    canvas.setDestinationCrs(mapCanvas.mapSettings().destinationCrs())
+    canvas.setLayers(mapCanvas.layers())
+    canvas.setExtent(mapCanvas.extent())
+    return canvas
+
+
+def runNavigationBenchmark(trackPath, layer=None, canvas=None, smoothing=True):
+    """
+    Replay a recorded track into the navigation panel.
+
+    :param trackPath: NMEA, GPX or CSV track, see gpsreplay.readTrack
+    :type trackPath: str
+
+    :param layer: Route to follow, the active layer if None. It is made the
+        active layer during the benchmark, as navigation follows that one.
+    :type layer: OptimalRouteLayer
+
+    :param canvas: Canvas the panel draws on, an offscreen copy of the KADAS
+        canvas if None
+    :type canvas: QgsMapCanvas
+
+    :returns: Latency percentiles and maximum in milliseconds by step, and
+        the number of fixes, navigation updates and fixes off the route
+    :rtype: dict
+    """
+    source = GpsReplaySource(trackPath)
+    activeLayer = iface.activeLayer()
+    layer = layer or activeLayer
+    if not isinstance(layer, OptimalRouteLayer) or not layer.hasRoute():
+        raise Exception("The benchmark needs a route layer with a computed route")
+    canvas = canvas or offscreenCanvas()
+
+    panel = NavigationPanel(canvas)
+    panel.smoothing = smoothing
+    panel.gpsConnection = source
+    panel.centerPin = KadasPinItem(QgsCoordinateReferenceSystem(4326))
+    # the same route is replayed every time, never replace it
+    panel.rerouteTrigger = RerouteTrigger(delay=math.inf)
+    panel.chkShowWarnings.setChecked(False)
+    replayTime = [0.0]
+    panel.clock = lambda: replayTime[0]
+
+    timings = {step: [] for step in BENCHMARK_STEPS}
+    counts = {"updates": 0, "offRoute": 0}
+    renderStart = []
+
+    def _timed(function, step):
+        def _wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings[step].append(time.perf_counter() - start)
+
+        return _wrapper
+
+    def _counted(function, counter):
+        def _wrapper(*args, **kwargs):
+            counts[counter] += 1
+            return function(*args, **kwargs)
+
+        return _wrapper
+
+    def _setHtml(html):
+        start = time.perf_counter()
+        setHtml(html)
+        # the layout, done when the panel reads the document height
+        panel.textBrowser.document().size()
+        timings["html"].append(time.perf_counter() - start)
+
+    def _renderStarting():
+        renderStart.append(time.perf_counter())
+
+    def _rendered():
+        if renderStart:
+            timings["render"].append(time.perf_counter() - renderStart.pop())
+
+    setHtml = panel.textBrowser.setHtml
+    panel.textBrowser.setHtml = _setHtml
+    panel.refreshCanvas = _timed(panel.refreshCanvas, "canvas")
+    panel.navigate = _counted(panel.navigate, "updates")
+    panel.offRoute = _counted(panel.offRoute, "offRoute")
+    layer.maneuverForPoint = _timed(layer.maneuverForPoint, "maneuver")
+    canvas.renderStarting.connect(_renderStarting)
+    canvas.mapCanvasRefreshed.connect(_rendered)
+    iface.setActiveLayer(layer)
+    layer.tracker.reset()
+    try:
+        for index, (fixTime, _) in enumerate(source.fixes):
+            source.index = index
+            replayTime[0] = fixTime
+            updates = counts["updates"]
+            start = time.perf_counter()
+            panel.gpsStateChanged(source.currentGPSInformation())
+            if counts["updates"] > updates:
+                timings["tick"].append(time.perf_counter() - start)
+            _waitForRender(canvas)
+    finally:
+        del layer.maneuverForPoint
+        canvas.renderStarting.disconnect(_renderStarting)
+        canvas.mapCanvasRefreshed.disconnect(_rendered)
+        panel.navigationCanvas.clear()
+        panel.deleteLater()
+        if activeLayer is not None:
+            iface.setActiveLayer(activeLayer)
+
+    results = {
+        "fixes": len(source.fixes),
+        "updates": counts["updates"],
+        "offRoute": counts["offRoute"],
+        "latency": {
+            step: _summary(values) for step, values in timings.items() if values
+        },
+    }
+    LOG.info("Navigation benchmark results: %s" % json.dumps(results, indent=2))
+    print(
+        "{} fixes, {} updates, {} off the route".format(
+            results["fixes"], results["updates"], results["offRoute"]
+        )
+    )
+    for step, summary in results["latency"].items():
+        print(
+            "{step:<10} ".format(step=step)
+            + " ".join(
+                "p{q} {value:8.3f}ms".format(q=q, value=summary["p%d" % q])
+                for q in BENCHMARK_PERCENTILES
+            )
+            + " max {value:8.3f}ms".format(value=summary["max"])
+        )
+    return results
+
+
+def _waitForRender(canvas):
+    loop = QEventLoop()
+    QTimer.singleShot(RENDER_START_DELAY_MS, loop.quit)
+    loop.exec_()
+    canvas.waitWhileRendering()
+
+
+def _summary(values):
+    summary = {
+        "p%d" % q: percentile(values, q) * 1000 for q in BENCHMARK_PERCENTILES
+    }
+    summary["max"] = max(values) * 1000
+    return summary
@@ -0,0 +1,77 @@
+import logging
+
+from qgis.core import QgsGeometry, QgsWkbTypes
+
+LOG = logging.getLogger(__name__)
+
+# Movement of the center in pixels, and change of rotation in degrees,
+# below which the canvas is not redrawn
+MIN_CENTER_PIXELS = 1.0
+MIN_ROTATION_DEGREES = 1.0
+
+
+class NavigationCanvas:
+    """
+    Keeps the map canvas centered on the vehicle during navigation.
+
+    The center and the rotation are changed together, with a single
+    repaint, and only when they differ enough from the current ones to be
+    visible. The route rubber band is transformed to the canvas CRS once
+    per route and CRS.
+    """
+
+    def __init__(self, canvas, rubberband):
+        self.canvas = canvas
+        self.rubberband = rubberband
+        self.routeGeometry = None
+        self.routeCrs = None
+
+    def update(self, center, rotation=None):
+        """
+        Center the canvas on a point in the canvas CRS, and rotate it if
+        rotation is not None. Return True if the canvas was redrawn.
+        """
+        moved = (
+            self.canvas.center().distance(center) / self.canvas.mapUnitsPerPixel()
+            >= MIN_CENTER_PIXELS
+        )
+        turned = (
+            rotation is not None
+            and abs((rotation - self.canvas.rotation() + 180) % 360 - 180)
+            >= MIN_ROTATION_DEGREES
+        )
+        if not moved and not turned:
+            return False
+        self.canvas.freeze(True)
+        try:
+            if moved:
+                self.canvas.setCenter(center)
+            if turned:
+                self.canvas.setRotation(rotation)
+        finally:
+            self.canvas.freeze(False)
+        self.canvas.refresh()
+        return True
+
+    def showRoute(self, geometry, transform):
+        """
+        Show a route geometry in EPSG:4326 with the rubber band, or hide it
+        if geometry is None.
+
+        :param transform: From EPSG:4326 to the canvas CRS
+        :type transform: QgsCoordinateTransform
+        """
+        crs = transform.destinationCrs() if geometry is not None else None
+        if geometry is self.routeGeometry and crs == self.routeCrs:
+            return
+        self.routeGeometry = geometry
+        self.routeCrs = crs
+        if geometry is None:
+            self.rubberband.reset(QgsWkbTypes.LineGeometry)
+            return
+        canvasGeometry = QgsGeometry(geometry)
+        canvasGeometry.transform(transform)
+        self.rubberband.setToGeometry(canvasGeometry)
+
+    def clear(self):
+        self.showRoute(None, None)
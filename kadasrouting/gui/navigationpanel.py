@@ -2,16 +2,15 @@ import os
 import math
 import datetime
 import json
+import time
 import logging
-import tempfile
 
 from PyQt5 import uic
-import re
-from zipfile import ZipFile
 
-from PyQt5.QtGui import QPixmap, QTransform, QPainter, QColor
+from PyQt5.QtGui import QColor
 
-from PyQt5.QtCore import Qt, QSize, QSettings, QTimer
+from PyQt5.QtCore import QSize, QSettings, QTimer
+from PyQt5.QtXml import QDomDocument
 
 from PyQt5.QtWidgets import QListWidgetItem, QListWidget, QLabel, QInputDialog
 
@@ -27,7 +26,7 @@ from qgis.core import (
     QgsPoint,
     QgsVectorLayer,
     QgsWkbTypes,
-    QgsGeometry,
+    QgsReadWriteContext,
 )
 
 from qgis.gui import QgsRubberBand
@@ -43,7 +42,13 @@ from kadas.kadasgui import (
 
 from kadasrouting.utilities import formatdist, pushMessage, iconPath
 from kadasrouting.core.optimalroutelayer import OptimalRouteLayer, NotInRouteException
+from kadasrouting.core.reroute import RerouteTrigger, autoRerouteEnabled
+from kadasrouting.core.updaterate import NavigationUpdateRate
+from kadasrouting.core.routecache import RouteCache, geometryFingerprint
+from kadasrouting.core.gpsfilter import GpsFilter, gpsSmoothingEnabled
 from kadasrouting.gui.gps import getGpsConnection
+from kadasrouting.gui.compass import CompassRenderer
+from kadasrouting.gui.navigationcanvas import NavigationCanvas
 from kadasrouting.core import vehicles
 from kadasrouting.utilities import tr
 
@@ -51,7 +56,8 @@ LOG = logging.getLogger(__name__)
 GPS_MIN_SPEED = (
     1.0  # speed above which we start to rotate the map and projecting the point
 )
-REFRESH_RATE_S = 1.0  # navigation panel refresh rate (in seconds)
+FALLBACK_REFRESH_RATE_S = 5.0  # refresh rate when the GPS sends no fix (in seconds)
+PROJECTION_HORIZON_S = 1.0  # time ahead of the fix at which the point is projected (in seconds)
 SPEED_DIVIDE_BY = (
     2.0  # variable used to divide the speed vector for the reprojected point
 )
@@ -197,58 +203,87 @@ def getInstructionsToWaypoint(waypoint, gpsinfo):
     }
 
 
+def fixKey(gpsinfo):
+    """Values identifying a GPS fix, to tell a new fix from the same one sent again"""
+    return (
+        getattr(gpsinfo, "utcDateTime", None),
+        gpsinfo.longitude,
+        gpsinfo.latitude,
+        gpsinfo.speed,
+        gpsinfo.direction,
+    )
+
+
 class NavigationFromWaypointsLayer:
-    def __init__(self):
-        self.crs = QgsCoordinateReferenceSystem(4326)
-        itemRegex = {
-            "KadasGpxRouteItemRegex": r'^<MapItem(.*)name="KadasGpxRouteItem"(.*)CDATA(.*)]><\/MapItem>',
-            "KadasGpxWaypointItemRegex": r'^<MapItem(.*)name="KadasGpxWaypointItem"(.*)CDATA(.*)]><\/MapItem>',
-        }
-        orig_project = {
-            "filename": QgsProject.instance().fileName(),
-        }
-        tmp_file = tempfile.NamedTemporaryFile(suffix=".qgz")
-        QgsProject.instance().setFileName(tmp_file.name)
-        QgsProject.instance().write()
-
-        # parse project
-        with ZipFile(tmp_file.name) as qgzPrj:
-            prjName = [x for x in qgzPrj.namelist() if "qgs" in x][0]
-            project_contents = str(qgzPrj.read(prjName)).split("\\n")
-        self.mapItems = []
-        for i in project_contents:
-            if "MapItem" in i:
-                for k, v in itemRegex.items():
-                    if k == "KadasGpxRouteItemRegex":
-                        # TODO: this is a placeholder if we must implement the
-                        # feature also for route items and not only for Waypoint Items
-                        # we'll need to differentiate the routes computed with valhalla from
-                        # the other ones...
-                        continue
-                    catched = re.match(itemRegex[k], i.strip())
-                    if catched:
-                        self.mapItems.append(
-                            self._create_gpx_waypoints(json.loads(catched[3]), k)
-                        )
-        QgsProject.instance().setFileName(orig_project["filename"])
-        try:
-            os.remove(tmp_file.name)
-        except FileNotFoundError:
-            # if the file is not there we don't worry
-            pass
+    """
+    The GPX waypoints of a KADAS item layer, for waypoint navigation.
+
+    Python cannot access the waypoint items of the layer directly, so the
+    layer is serialized in memory and the waypoints are read from its
+    MapItem elements. Waypoints are cached per layer until the layer is
+    repainted or changed.
+    """
+
+    WAYPOINT_ITEM = "KadasGpxWaypointItem"
 
-    def _create_gpx_waypoints(self, map_item, key):
+    _cache = {}
+
+    def __init__(self, layer):
+        self.crs = QgsCoordinateReferenceSystem(4326)
+        self.mapItems = NavigationFromWaypointsLayer.waypointItems(layer)
+
+    @staticmethod
+    def waypointItems(layer):
+        layerId = layer.id()
+        cache = NavigationFromWaypointsLayer._cache
+        if layerId not in cache:
+            cache[layerId] = NavigationFromWaypointsLayer._readWaypointItems(layer)
+
+            def _invalidate():
+                cache.pop(layerId, None)
+                for signal in (layer.repaintRequested, layer.dataChanged):
+                    try:
+                        signal.disconnect(_invalidate)
+                    except TypeError:
+                        pass
+
+            layer.repaintRequested.connect(_invalidate)
+            layer.dataChanged.connect(_invalidate)
+        return cache[layerId]
+
+    @staticmethod
+    def _readWaypointItems(layer):
+        doc = QDomDocument()
+        node = doc.createElement("maplayer")
+        doc.appendChild(node)
+        layer.writeXml(node, doc, QgsReadWriteContext())
+        mapItems = []
+        elements = node.toElement().elementsByTagName("MapItem")
+        for i in range(elements.count()):
+            element = elements.at(i).toElement()
+            # TODO: KadasGpxRouteItem elements could be supported here too, we
+            # would need to differentiate the routes computed with valhalla
+            # from the other ones, and to track the passed waypoints
+            if element.attribute("name") != NavigationFromWaypointsLayer.WAYPOINT_ITEM:
+                continue
+            try:
+                mapItems.append(
+                    NavigationFromWaypointsLayer._createGpxWaypoint(
+                        json.loads(element.text())
+                    )
+                )
+            except (ValueError, KeyError, IndexError) as e:
+                LOG.warning("Could not read waypoint item: %s" % e)
+        return mapItems
+
+    @staticmethod
+    def _createGpxWaypoint(mapItem):
+        if isinstance(mapItem, list):
+            mapItem = mapItem[0]
         item = KadasGpxWaypointItem()
-        if key == "KadasGpxWaypointItemRegex":
-            p = map_item[0]["state"]["points"][0]
-            item.addPartFromGeometry(QgsPoint(p[0], p[1]))
-        elif key == "KadasGpxRouteItemRegex":
-            # FIXME: this will need more stuff to work, for the routes we must
-            # add a way to track the passed waypoints, and use the layer internal points
-            # as polyline instead
-            for p in map_item[0]["state"]["points"][0]:
-                item.addPartFromGeometry(QgsPoint(p[0], p[1]))
-        item.setName(map_item[0]["props"]["name"])
+        p = mapItem["state"]["points"][0]
+        item.addPartFromGeometry(QgsPoint(p[0], p[1]))
+        item.setName(mapItem["props"]["name"])
         return item
 
     def items(self):
@@ -261,26 +296,53 @@ class NavigationPanel(BASE, WIDGET):
     FIXED_WIDTH = 200
     WARNING_DISTANCE = 200
 
-    def __init__(self):
+    def __init__(self, canvas=None):
+        """
+        :param canvas: The canvas to follow the vehicle on, the KADAS map
+            canvas if None
+        :type canvas: QgsMapCanvas
+        """
         super().__init__()
         self.setupUi(self)
         self.setStyleSheet("background-color: #333f4f;")
         self.textBrowser.setStyleSheet("background-color: #adb9ca;")
         self.listWaypoints.setStyleSheet("background-color: #adb9ca;")
         self.iface = KadasPluginInterface.cast(iface)
+        self.canvas = canvas or iface.mapCanvas()
+        # Time in seconds of the GPS fixes, the replay time in benchmarks
+        self.clock = time.monotonic
         self.gpsConnection = None
         self.navLayer = None
         self.listWaypoints.setSelectionMode(QListWidget.SingleSelection)
         self.listWaypoints.currentItemChanged.connect(self.selectedWaypointChanged)
         self.listWaypoints.setSpacing(5)
         self.waypointWidgets = []
-        self.optimalRoutesCache = {}
+        self.optimalRoutesCache = RouteCache()
+        self.lineFingerprints = {}
+        self.failedRoutes = set()
+        self.rerouteTrigger = RerouteTrigger()
+        self.compass = CompassRenderer(self.FIXED_WIDTH)
+        self.updateRate = NavigationUpdateRate()
+        self.gpsFilter = GpsFilter()
+        self.smoothing = gpsSmoothingEnabled()
+        self.filteredFix = None
+        self.lastFixKey = None
+        self.transform = None
+        self.distanceArea = QgsDistanceArea()
+        self.distanceArea.setSourceCrs(
+            QgsCoordinateReferenceSystem(4326),
+            QgsProject.instance().transformContext(),
+        )
+        self.distanceArea.setEllipsoid(self.distanceArea.sourceCrs().ellipsoidAcronym())
+        self.warningThreshold = self.WARNING_DISTANCE
 
         self.timer = QTimer()
+        self.timer.timeout.connect(self.refreshIfStale)
 
-        self.rubberband = QgsRubberBand(iface.mapCanvas(), QgsWkbTypes.LineGeometry)
+        self.rubberband = QgsRubberBand(self.canvas, QgsWkbTypes.LineGeometry)
         self.rubberband.setStrokeColor(QColor(150, 0, 0))
         self.rubberband.setWidth(2)
+        self.navigationCanvas = NavigationCanvas(self.canvas, self.rubberband)
 
         self.chkShowWarnings.setChecked(True)
         self.warningShown = False
@@ -288,17 +350,20 @@ class NavigationPanel(BASE, WIDGET):
         self.labelConfigureWarnings.linkActivated.connect(self.configureWarnings)
 
     def configureWarnings(self, url):
-        threshold = QSettings().value(
-            "kadasrouting/warningThreshold", self.WARNING_DISTANCE, type=int
-        )
         value, ok = QInputDialog.getInt(
             self.iface.mainWindow(),
             self.tr("Navigation"),
             self.tr("Set threshold for warnings (meters)"),
-            threshold,
+            self.readWarningThreshold(),
         )
         if ok:
             QSettings().setValue("kadasrouting/warningThreshold", value)
+            self.warningThreshold = value
+
+    def readWarningThreshold(self):
+        return QSettings().value(
+            "kadasrouting/warningThreshold", self.WARNING_DISTANCE, type=int
+        )
 
     def setWarningShownOff(self):
         self.warningShown = False
@@ -311,19 +376,53 @@ class NavigationPanel(BASE, WIDGET):
         super().hide()
         self.stopNavigation()
 
-    def updateNavigationInfo(self):
+    def gpsStateChanged(self, gpsinfo):
+        if self.updateRate.isDue(gpsinfo, self.clock()):
+            self.updateNavigationInfo(gpsinfo)
+
+    def refreshIfStale(self):
+        """Update from the last known fix if the GPS has not sent any for a while"""
+        lastUpdate = self.updateRate.lastTime
+        if (
+            lastUpdate is None
+            or self.clock() - lastUpdate >= FALLBACK_REFRESH_RATE_S
+        ):
+            self.updateNavigationInfo()
+
+    def updateNavigationInfo(self, gpsinfo=None):
         if self.gpsConnection is None:
             self.setMessage(self.tr("Cannot connect to GPS"))
             return
-        try:
-            gpsinfo = self.gpsConnection.currentGPSInformation()
-        except RuntimeError:
-            # if the GPS is closed in KADAS main interface, stop the navigation
-            self.stopNavigation()
-            return
+        if gpsinfo is None:
+            try:
+                gpsinfo = self.gpsConnection.currentGPSInformation()
+            except RuntimeError:
+                # if the GPS is closed in KADAS main interface, stop the navigation
+                self.stopNavigation()
+                return
         if gpsinfo is None:
             self.setMessage(self.tr("Cannot connect to GPS"))
             return
+        distanceToManeuver = self.navigate(gpsinfo)
+        self.updateRate.updated(gpsinfo, self.clock(), distanceToManeuver)
+
+    def navigate(self, gpsinfo):
+        """
+        Update the panel and the canvas for a GPS fix.
+
+        :returns: The distance in meters to the next maneuver, or None if not
+            following a route
+        :rtype: float
+        """
+        if self.smoothing:
+            # the smoothed fix has the attributes of gpsinfo used below. A fix
+            # already filtered, as refreshed when the GPS is silent, is not
+            # fed again: the filter would take it for a vehicle standing still
+            key = fixKey(gpsinfo)
+            if self.filteredFix is None or key != self.lastFixKey:
+                self.filteredFix = self.gpsFilter.update(gpsinfo, self.clock())
+                self.lastFixKey = key
+            gpsinfo = self.filteredFix
         layer = self.iface.activeLayer()
         LOG.debug("Debug: type(layer) = {}".format(type(layer)))
         point = QgsPointXY(gpsinfo.longitude, gpsinfo.latitude)
@@ -332,50 +431,58 @@ class NavigationPanel(BASE, WIDGET):
             # project the current point using the speed vector instead
             # of using 'point' directly, otherwise we get to feel of being
             # "behind the current position"
-            qgsdistance = QgsDistanceArea()
-            qgsdistance.setSourceCrs(
-                QgsCoordinateReferenceSystem(4326),
-                QgsProject.instance().transformContext(),
-            )
-            qgsdistance.setEllipsoid(qgsdistance.sourceCrs().ellipsoidAcronym())
-            point = qgsdistance.computeSpheroidProject(
+            point = self.distanceArea.computeSpheroidProject(
                 point,
-                (gpsinfo.speed / SPEED_DIVIDE_BY) * REFRESH_RATE_S,
+                (gpsinfo.speed / SPEED_DIVIDE_BY) * PROJECTION_HORIZON_S,
                 math.radians(gpsinfo.direction),
             )
-        origCrs = QgsCoordinateReferenceSystem(4326)
-        canvasCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
-        self.transform = QgsCoordinateTransform(
-            origCrs, canvasCrs, QgsProject.instance()
-        )
+        self.updateTransform()
 
+        routeGeometry = None
         if (
             isinstance(layer, QgsVectorLayer)
             and layer.geometryType() == QgsWkbTypes.LineGeometry
         ):
-            feature = next(layer.getFeatures(), None)
-            if feature:
-                geom = feature.geometry()
-                layer = self.getOptimalRouteLayerForGeometry(geom)
+            fingerprint, geom = self.lineFingerprint(layer)
+            if fingerprint in self.failedRoutes:
+                # the error was already shown, do not ask for a vehicle again
+                self.setMessage(
+                    self.tr("Could not compute the route from layer '{name}'").format(
+                        name=layer.name()
+                    )
+                )
+                self.stopNavigation()
+                return
+            if fingerprint is not None:
+                layer = self.getOptimalRouteLayerForGeometry(fingerprint, geom)
                 if layer is not None:
-                    rubbergeom = QgsGeometry(layer.geom)
-                    rubbergeom.transform(self.transform)
-                    self.rubberband.setToGeometry(rubbergeom)
+                    routeGeometry = layer.geom
+        self.navigationCanvas.showRoute(routeGeometry, self.transform)
 
+        if (
+            isinstance(layer, OptimalRouteLayer)
+            and layer.isComputing()
+            and not layer.hasRoute()
+        ):
+            self.refreshCanvas(point, gpsinfo)
+            self.setMessage(self.tr("Computing the route..."))
+            return
         if hasattr(layer, "valhalla") and layer.hasRoute():
             try:
                 maneuver = layer.maneuverForPoint(point, gpsinfo.speed)
                 self.refreshCanvas(maneuver["closest_point"], gpsinfo)
+                self.rerouteTrigger.onRoute(maneuver["closest_point"])
                 LOG.debug(maneuver)
             except NotInRouteException:
                 self.refreshCanvas(point, gpsinfo)
-                self.setMessage(self.tr("You are not on the route"))
+                self.offRoute(layer, point)
                 return
             self.setWidgetsVisibility(False)
             html = route_html_template.format(**maneuver)
             self.textBrowser.setHtml(html)
             self.textBrowser.setFixedHeight(self.textBrowser.document().size().height())
             self.setWarnings(maneuver["raw_distleft"])
+            return maneuver["raw_dist"]
         # FIXME: we could have some better way of differentiating this...
         elif not isinstance(layer, type(None)):
             if layer.name() != "Routes":
@@ -390,7 +497,7 @@ class NavigationPanel(BASE, WIDGET):
                     self.waypointLayer = self.navLayer
                     self.populateWaypoints(waypoints)
                 else:
-                    self.updateWaypoints()
+                    self.updateWaypoints(gpsinfo)
                 waypointItem = (
                     self.listWaypoints.currentItem() or self.listWaypoints.item(0)
                 )
@@ -416,26 +523,47 @@ class NavigationPanel(BASE, WIDGET):
             self.stopNavigation()
             return
 
+    def offRoute(self, layer, point):
+        """Show that the vehicle left the route, and reroute if it is time"""
+        rerouting = isinstance(layer, OptimalRouteLayer) and layer.isComputing()
+        if (
+            not rerouting
+            and isinstance(layer, OptimalRouteLayer)
+            and autoRerouteEnabled()
+            and layer.canReroute()
+            and self.rerouteTrigger.offRoute(point, self.clock())
+        ):
+            layer.reroute(point)
+            rerouting = True
+        if rerouting:
+            self.setMessage(self.tr("You are not on the route, computing a new route..."))
+        else:
+            self.setMessage(self.tr("You are not on the route"))
+
+    def updateTransform(self):
+        """Update the transform to the canvas CRS, if it has changed"""
+        canvasCrs = self.canvas.mapSettings().destinationCrs()
+        if self.transform is None or self.transform.destinationCrs() != canvasCrs:
+            self.transform = QgsCoordinateTransform(
+                QgsCoordinateReferenceSystem(4326), canvasCrs, QgsProject.instance()
+            )
+
     def refreshCanvas(self, point, gpsinfo):
         canvasPoint = self.transform.transform(point)
         self.centerPin.setPosition(KadasItemPos(point.x(), point.y()))
-        self.iface.mapCanvas().setCenter(canvasPoint)
         # stop rotating the map like a crazy when the user is almost still,
         # i.e. rotate only if we move faster than 1m/s
+        rotation = None
         if gpsinfo.speed > GPS_MIN_SPEED:
-            self.iface.mapCanvas().setRotation(-gpsinfo.direction)
+            rotation = -gpsinfo.direction
             self.centerPin.setAngle(0)
-        self.iface.mapCanvas().refresh()
-        self.rubberband.reset(QgsWkbTypes.LineGeometry)
+        self.navigationCanvas.update(canvasPoint, rotation)
 
     def setWarnings(self, dist):
-        threshold = QSettings().value(
-            "kadasrouting/warningThreshold", self.WARNING_DISTANCE, type=int
-        )
         if (
             self.chkShowWarnings.isChecked()
             and not self.warningShown
-            and dist < threshold
+            and dist < self.warningThreshold
         ):
             pushMessage(
                 self.tr("In {dist} meters you will arrive at your destination").format(
@@ -444,10 +572,42 @@ class NavigationPanel(BASE, WIDGET):
             )
             self.warningShown = True
 
-    def getOptimalRouteLayerForGeometry(self, geom):
-        wkt = geom.asWkt()
-        if wkt in self.optimalRoutesCache:
-            return self.optimalRoutesCache[wkt]
+    def lineFingerprint(self, layer):
+        """
+        Return the fingerprint and the geometry of the first feature of a
+        line layer, or (None, None) if it has none. They are memoized until
+        the layer is repainted or changed.
+        """
+        layerId = layer.id()
+        if layerId not in self.lineFingerprints:
+            feature = next(layer.getFeatures(), None)
+            if feature:
+                geom = feature.geometry()
+                self.lineFingerprints[layerId] = (geometryFingerprint(geom), geom)
+            else:
+                self.lineFingerprints[layerId] = (None, None)
+
+            def _invalidate():
+                self.lineFingerprints.pop(layerId, None)
+                for signal in (layer.repaintRequested, layer.dataChanged):
+                    try:
+                        signal.disconnect(_invalidate)
+                    except TypeError:
+                        pass
+
+            layer.repaintRequested.connect(_invalidate)
+            layer.dataChanged.connect(_invalidate)
+        return self.lineFingerprints[layerId]
+
+    def getOptimalRouteLayerForGeometry(self, fingerprint, geom):
+        """
+        Return the route matched to a line geometry. On a cache miss the
+        matching is started in the background, and the returned layer has
+        no route until it is done.
+        """
+        cached = self.optimalRoutesCache.get(fingerprint)
+        if cached is not None:
+            return cached
 
         name = self.iface.activeLayer().name()
         value, ok = QInputDialog.getItem(
@@ -467,38 +627,33 @@ class NavigationPanel(BASE, WIDGET):
                     line = polyline[0]
                 else:
                     line = geom.asPolyline()
-                layer.updateFromPolyline(line, profile, costingOptions)
-                self.optimalRoutesCache[wkt] = layer
-                return layer
-            except Exception:
+                task = layer.updateFromPolyline(line, profile, costingOptions)
+            except Exception as e:
+                LOG.warning(e)
                 return
 
+            def _failed(e):
+                # the matching is tried again when the navigation is restarted
+                if self.optimalRoutesCache.get(fingerprint) is layer:
+                    self.optimalRoutesCache.remove(fingerprint)
+                self.failedRoutes.add(fingerprint)
+                self.updateNavigationInfo()
+
+            task.requestFailed.connect(_failed)
+            # the memory bound of the cache counts finished routes only
+            task.responseReady.connect(lambda _: self.optimalRoutesCache.prune())
+            self.optimalRoutesCache.put(fingerprint, layer)
+            return layer
+
     def setCompass(self, heading, wpangle):
-        compassPixmap = QPixmap(iconPath("compass.png"))
-        compassPixmap = compassPixmap.scaledToWidth(self.FIXED_WIDTH)
-        bearingPixmap = QPixmap(iconPath("direction.png"))
-        pixmap = QPixmap(self.FIXED_WIDTH, self.FIXED_WIDTH)
-        pixmap.fill(Qt.transparent)
-        painter = QPainter(pixmap)
-        transform = QTransform()
-        transform.translate(self.FIXED_WIDTH / 2, self.FIXED_WIDTH / 2)
-        transform.rotate(-heading)
-        transform.translate(-self.FIXED_WIDTH / 2, -self.FIXED_WIDTH / 2)
-        painter.setTransform(transform)
-        painter.drawPixmap(0, 0, self.FIXED_WIDTH, self.FIXED_WIDTH, compassPixmap)
-        transform = QTransform()
-        transform.translate(self.FIXED_WIDTH / 2, self.FIXED_WIDTH / 2)
-        transform.rotate(wpangle - heading)
-        transform.translate(-self.FIXED_WIDTH / 2, -self.FIXED_WIDTH / 2)
-        painter.setTransform(transform)
-        painter.drawPixmap(0, 0, self.FIXED_WIDTH, self.FIXED_WIDTH, bearingPixmap)
-        painter.end()
-        self.labelCompass.setPixmap(pixmap)
-        self.labelCompass.resize(QSize(self.FIXED_WIDTH, self.FIXED_WIDTH))
-
-    def updateWaypoints(self):
+        pixmap = self.compass.render(heading, wpangle)
+        if pixmap is not None:
+            self.labelCompass.setPixmap(pixmap)
+            self.labelCompass.resize(QSize(self.FIXED_WIDTH, self.FIXED_WIDTH))
+
+    def updateWaypoints(self, gpsinfo):
         for item, w in self.waypointWidgets:
-            w.setWaypointText(self.gpsConnection.currentGPSInformation())
+            w.setWaypointText(gpsinfo)
 
     def selectedWaypointChanged(self, current, previous):
         for item, w in self.waypointWidgets:
@@ -561,6 +716,15 @@ class NavigationPanel(BASE, WIDGET):
 
     def startNavigation(self):
         self.centerPin = None
+        self.rerouteTrigger.reset()
+        self.compass.reset()
+        self.updateRate.reset()
+        self.gpsFilter.reset()
+        self.failedRoutes.clear()
+        self.smoothing = gpsSmoothingEnabled()
+        self.filteredFix = None
+        self.lastFixKey = None
+        self.warningThreshold = self.readWarningThreshold()
         self.waypointLayer = None
         self.warningShown = False
         self.originalGpsMarker = None
@@ -569,16 +733,9 @@ class NavigationPanel(BASE, WIDGET):
         self.gpsConnection = getGpsConnection()
         try:
             if iface.activeLayer().name() == "Routes":
-                self.navLayer = NavigationFromWaypointsLayer()
+                self.navLayer = NavigationFromWaypointsLayer(iface.activeLayer())
         except AttributeError:
             pass
-        except FileNotFoundError:
-            self.setMessage(
-                self.tr(
-                    "You must save your project to use waypoint layers for navigation"
-                )
-            )
-            return
         except TypeError:
             self.setMessage(self.tr("There are no waypoints in the 'Routes' layer"))
             return
@@ -601,8 +758,8 @@ class NavigationPanel(BASE, WIDGET):
             )
             KadasMapCanvasItemManager.addItem(self.centerPin)
             self.updateNavigationInfo()
-            self.timer.start(REFRESH_RATE_S * 1000)
-            self.timer.timeout.connect(self.updateNavigationInfo)
+            self.gpsConnection.stateChanged.connect(self.gpsStateChanged)
+            self.timer.start(FALLBACK_REFRESH_RATE_S * 1000)
         self.iface.layerTreeView().currentLayerChanged.connect(self.currentLayerChanged)
 
     def currentLayerChanged(self, layer):
@@ -612,10 +769,10 @@ class NavigationPanel(BASE, WIDGET):
 
     def stopNavigation(self):
         if self.gpsConnection is not None:
+            self.timer.stop()
             try:
-                self.timer.timeout.disconnect(self.updateNavigationInfo)
-                self.timer.stop()
-            except TypeError as e:
+                self.gpsConnection.stateChanged.disconnect(self.gpsStateChanged)
+            except (TypeError, RuntimeError) as e:
                 LOG.debug(e)
         try:
             if self.centerPin is not None:
@@ -631,9 +788,9 @@ class NavigationPanel(BASE, WIDGET):
             LOG.debug(e)
         # Finally, reset everything
         self.addOriginalGpsMarker()
-        self.rubberband.reset(QgsWkbTypes.LineGeometry)
-        self.iface.mapCanvas().setRotation(0)
-        self.iface.mapCanvas().refresh()
+        self.navigationCanvas.clear()
+        self.canvas.setRotation(0)
+        self.canvas.refresh()
 
     def removeOriginalGpsMarker(self):
         for item in KadasMapCanvasItemManager.items():
@@ -11,6 +11,7 @@ from kadas.kadasgui import (
 )
 from kadasrouting.gui.locationinputwidget import LocationInputWidget
 from kadasrouting.utilities import iconPath
+from kadasrouting.valhalla.client import ValhallaClient
 
 from qgis.core import QgsCoordinateReferenceSystem
 
@@ -63,6 +64,49 @@ class OptimalRouteBottomBar(ValhallaRouteBottomBar, WIDGET):
         # Create/add new waypoint pin for the waypoint
         self.addWaypointPin(waypoint)
 
+    def calculate(self):
+        if not self.checkBoxOptimizeOrder.isChecked() or len(self.waypoints) < 2:
+            super().calculate()
+            return
+        try:
+            (
+                layer,
+                points,
+                profile,
+                allAreasToAvoidWGS,
+                costingOptions,
+            ) = self.prepareValhalla()
+        except TypeError:
+            # exit if prepareValhalla raised a warning to the user
+            return
+        waypoints = list(self.waypoints)
+
+        def _optimized(response):
+            # Waypoints may have been edited while the route was computed
+            if self.waypoints == waypoints:
+                self.reorderWaypoints(ValhallaClient.optimizedOrder(response))
+
+        task = layer.updateRoute(
+            points, profile, allAreasToAvoidWGS, costingOptions, optimize=True
+        )
+        task.responseReady.connect(_optimized)
+        task.responseReady.connect(self.routeComputed)
+
+    def reorderWaypoints(self, order):
+        """
+        Reorder waypoints, their pins and their names as in an optimized
+        route, order being the indices of all the route points, origin and
+        destination included.
+        """
+        waypointOrder = [i - 1 for i in order[1:-1]]
+        if waypointOrder == list(range(len(self.waypoints))):
+            return
+        self.waypoints = [self.waypoints[i] for i in waypointOrder]
+        self.waypointPins = [self.waypointPins[i] for i in waypointOrder]
+        names = self.lineEditWaypoints.text().split(";")
+        if len(names) == len(waypointOrder):
+            self.lineEditWaypoints.setText(";".join(names[i] for i in waypointOrder))
+
     def reverse(self):
         super().reverse()
         # Reverse waypoints' order
@@ -156,7 +156,7 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
         colors = []
         try:
             colors = self.getColorFromInterval()
-            generateIsochrones(
+            task = generateIsochrones(
                 point,
                 profile,
                 costingOptions,
@@ -170,7 +170,16 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
             pushWarning(
                 self.tr("Please change the basename or activate the overwrite checkbox")
             )
-        except Valhalla400Exception as e:
+            return
+        task.requestFailed.connect(self.isochronesFailed)
+
+    def isochronesFailed(self, e):
+        if isinstance(e, OverwriteError):
+            LOG.error(e)
+            pushWarning(
+                self.tr("Please change the basename or activate the overwrite checkbox")
+            )
+        elif isinstance(e, Valhalla400Exception):
             # Expecting the content can be parsed as JSON, see
             # https://valhalla.readthedocs.io/en/latest/api/turn-by-turn/api-reference/#http-status-codes-and-conditions
             json_error = json.loads(str(e))
@@ -179,9 +188,9 @@ class ReachabilityBottomBar(KadasBottomBar, WIDGET):
                     error_message=json_error.get("error")
                 )
             )
-        except Exception as e:
+        else:
+            LOG.error(e)
             pushWarning("could not generate isochrones")
-            raise Exception(e)
 
     def actionToggled(self, toggled):
         if toggled:
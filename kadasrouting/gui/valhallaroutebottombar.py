@@ -286,15 +286,11 @@ class ValhallaRouteBottomBar(KadasBottomBar):
         except TypeError:
             # exit if prepareValhalla raised a warning to the user
             return
-        try:
-            layer.updateRoute(points, profile, allAreasToAvoidWGS, costingOptions)
-            self.btnNavigate.setEnabled(True)
-        except Exception as e:
-            LOG.error(e, exc_info=True)
-            # TODO more fine-grained error control
-            pushWarning(self.tr("Could not compute route"))
-            LOG.error("Could not compute route")
-            raise (e)
+        task = layer.updateRoute(points, profile, allAreasToAvoidWGS, costingOptions)
+        task.responseReady.connect(self.routeComputed)
+
+    def routeComputed(self, response):
+        self.btnNavigate.setEnabled(True)
 
     def clearPoints(self):
         # remove pins and points
@@ -149,6 +149,7 @@ class RoutingPlugin(QObject):
             self.dayNightAction, self.iface.PLUGIN_MENU, self.iface.GPS_TAB
         )
         self._saver.detachFromProject()
+        ValhallaClient.getInstance().shutdown()
 
     def _showPanel(self, action, show):
         function = self.actionsToggled[action]
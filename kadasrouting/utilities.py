@@ -4,7 +4,10 @@ import itertools
 import io
 import math
 import json
+import sys
+import struct
 import logging
+from array import array
 from datetime import datetime
 
 
@@ -20,9 +23,15 @@ from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
     QgsProject,
+    QgsGeometry,
     Qgis,
 )
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 LOG = logging.getLogger(__name__)
 
 
@@ -184,6 +193,106 @@ def encodePolyline6(coordinates, precision=6, geojson=False):
     return PolylineCodec().encode(coordinates, precision, geojson)
 
 
+def decodePolyline6Arrays(expression, precision=6):
+    """
+    Decode a polyline into contiguous arrays of longitudes and latitudes.
+
+    The values are identical to the ones of decodePolyline6. The arrays are
+    numpy float64 arrays if numpy is available, array.array("d") otherwise.
+
+    :returns: The longitudes and the latitudes
+    :rtype: tuple
+    """
+    if numpy is not None:
+        return _decodePolylineNumpy(expression, float(10 ** precision))
+    return _decodePolylinePython(expression, float(10 ** precision))
+
+
+def _decodePolylineNumpy(expression, factor):
+    chunks = numpy.frombuffer(expression.encode("ascii"), dtype=numpy.uint8)
+    chunks = chunks.astype(numpy.int64) - 63
+    if not len(chunks):
+        return numpy.empty(0), numpy.empty(0)
+    if chunks.min() < 0 or chunks.max() > 0x3F:
+        raise ValueError("Invalid polyline")
+    # Each value is a run of 5 bits chunks, the last one lower than 0x20
+    last = chunks < 0x20
+    if not last[-1]:
+        raise ValueError("Invalid polyline")
+    starts = numpy.flatnonzero(numpy.concatenate(([True], last[:-1])))
+    positions = numpy.arange(len(chunks)) - numpy.repeat(
+        starts, numpy.diff(numpy.append(starts, len(chunks)))
+    )
+    if positions.max() * 5 > 57:
+        # the value would overflow 64 bits
+        raise ValueError("Invalid polyline")
+    values = numpy.add.reduceat((chunks & 0x1F) << (5 * positions), starts)
+    values = numpy.where(values & 1, ~(values >> 1), values >> 1)
+    if len(values) % 2:
+        raise ValueError("Invalid polyline")
+    lats = numpy.cumsum(values[0::2]) / factor
+    lons = numpy.cumsum(values[1::2]) / factor
+    return lons, lats
+
+
+def _decodePolylinePython(expression, factor):
+    lons, lats = array("d"), array("d")
+    lat = lon = 0
+    values = []
+    result = shift = 0
+    for char in expression:
+        chunk = ord(char) - 63
+        if not 0 <= chunk <= 0x3F:
+            raise ValueError("Invalid polyline")
+        result |= (chunk & 0x1F) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            result = shift = 0
+            if len(values) == 2:
+                lat += values[0]
+                lon += values[1]
+                lats.append(lat / factor)
+                lons.append(lon / factor)
+                values = []
+    if values or shift:
+        raise ValueError("Invalid polyline")
+    return lons, lats
+
+
+def concatenateArrays(arrays):
+    """Concatenate coordinate arrays returned by decodePolyline6Arrays"""
+    if numpy is not None:
+        return numpy.concatenate(arrays) if arrays else numpy.empty(0)
+    result = array("d")
+    for a in arrays:
+        result.extend(a)
+    return result
+
+
+def lineGeometryFromArrays(xs, ys):
+    """
+    Build a line geometry from arrays of coordinates, as returned by
+    decodePolyline6Arrays. The geometry is built from WKB, so no Python
+    object is created per vertex.
+
+    :rtype: QgsGeometry
+    """
+    if numpy is not None:
+        coords = numpy.empty(2 * len(xs), dtype=numpy.float64)
+        coords[0::2] = xs
+        coords[1::2] = ys
+    else:
+        coords = array("d", bytes(16 * len(xs)))
+        coords[0::2] = array("d", xs)
+        coords[1::2] = array("d", ys)
+    byteOrder = 1 if sys.byteorder == "little" else 0
+    header = struct.pack("=BII", byteOrder, 2, len(xs))
+    geom = QgsGeometry()
+    geom.fromWkb(header + coords.tobytes())
+    return geom
+
+
 def formatdist(d):
     if d is None:
         return ""
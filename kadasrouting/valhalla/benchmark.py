@@ -0,0 +1,144 @@
+"""
+Benchmark of the valhalla performance profiles on the active map package.
+
+Run it from the KADAS python console:
+
+    from kadasrouting.valhalla.benchmark import runBenchmark
+    runBenchmark()
+
+Each profile runs the same route and isochrone workload. The first call
+of each request after switching profile is reported as cold, the median of
+the following ones as warm.
+"""
+
+import json
+import time
+import logging
+import statistics
+
+from qgis.core import QgsPointXY, QgsSettings
+
+from kadasrouting.core.datacatalogueclient import DataCatalogueClient
+from kadasrouting.valhalla.client import ValhallaClient
+from kadasrouting.valhalla import performance
+
+LOG = logging.getLogger(__name__)
+
+BENCHMARK_PROFILE = "auto"
+BENCHMARK_INTERVALS = [10, 20, 30]
+BENCHMARK_COLORS = ["00CC00", "CCCC00", "CC0000"]
+
+
+def workloadPoints(itemid):
+    """
+    Return the origin and destination of the benchmark route, at 25% and
+    75% of the diagonal of the package extent. The origin is also the
+    center of the isochrones.
+    """
+    data = DataCatalogueClient.localMetadata(itemid)
+    try:
+        (xmin, ymin), (xmax, ymax) = data["extent"]
+    except (KeyError, TypeError, ValueError):
+        raise Exception(
+            "The map package has no extent, please pass origin and destination"
+        )
+    origin = QgsPointXY(xmin + (xmax - xmin) * 0.25, ymin + (ymax - ymin) * 0.25)
+    destination = QgsPointXY(xmin + (xmax - xmin) * 0.75, ymin + (ymax - ymin) * 0.75)
+    return origin, destination
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmarkProfile(client, profile, origin, destination, repetitions):
+    performance.setActiveProfile(profile)
+    # Long-lived valhalla processes must pick up the new cache settings
+    client.shutdown()
+    timings = {"route": [], "isochrone": []}
+    for _ in range(repetitions):
+        timings["route"].append(
+            _timed(client.route, [origin, destination], BENCHMARK_PROFILE, None, {})
+        )
+        timings["isochrone"].append(
+            _timed(
+                client.isochrones,
+                origin,
+                BENCHMARK_PROFILE,
+                {},
+                BENCHMARK_INTERVALS,
+                BENCHMARK_COLORS,
+            )
+        )
+    result = {}
+    for request, values in timings.items():
+        result[request] = {
+            "cold": values[0],
+            "warm": statistics.median(values[1:]) if len(values) > 1 else None,
+        }
+    return result
+
+
+def runBenchmark(profiles=None, origin=None, destination=None, repetitions=5):
+    """
+    Run the benchmark workload under each performance profile.
+
+    :param profiles: Profile names, all the presets and custom if None
+    :type profiles: list
+
+    :param origin: Route origin and isochrone center in EPSG:4326, taken
+        from the package extent if None
+    :type origin: QgsPointXY
+
+    :param destination: Route destination in EPSG:4326
+    :type destination: QgsPointXY
+
+    :param repetitions: Number of times each request is run per profile
+    :type repetitions: int
+
+    :returns: Timings in seconds, by profile and request
+    :rtype: dict
+    """
+    client = ValhallaClient.getInstance()
+    if origin is None or destination is None:
+        itemid = QgsSettings().value("/kadasrouting/activeValhallaTilesID")
+        origin, destination = workloadPoints(itemid)
+    profiles = profiles or performance.profileNames()
+    previousProfile = performance.activeProfile()
+    # Cached responses would hide the engine timings
+    cacheEnabled = client.connector.cache.enabled
+    client.connector.cache.enabled = False
+    results = {}
+    try:
+        for profile in profiles:
+            LOG.info("Benchmarking performance profile %s" % profile)
+            results[profile] = {
+                "settings": performance.cacheSettings(profile),
+                "timings": benchmarkProfile(
+                    client, profile, origin, destination, repetitions
+                ),
+            }
+    finally:
+        client.connector.cache.enabled = cacheEnabled
+        performance.setActiveProfile(previousProfile)
+        client.shutdown()
+    LOG.info("Benchmark results: %s" % json.dumps(results, indent=2))
+    for profile, result in results.items():
+        timings = result["timings"]
+        print(
+            "{profile:<12} route cold {rc:7.3f}s warm {rw} | "
+            "isochrone cold {ic:7.3f}s warm {iw}".format(
+                profile=profile,
+                rc=timings["route"]["cold"],
+                rw=_format(timings["route"]["warm"]),
+                ic=timings["isochrone"]["cold"],
+                iw=_format(timings["isochrone"]["warm"]),
+            )
+        )
+    return results
+
+
+def _format(value):
+    return "   n/a " if value is None else "{:7.3f}s".format(value)
@@ -0,0 +1,152 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_ENTRIES = 32
+DEFAULT_DISK_SIZE = 200 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Two-tier cache of valhalla responses.
+
+    Responses are kept in an in-memory LRU of at most `memoryEntries`
+    entries, backed by a folder of JSON files capped at `diskSize` bytes,
+    oldest used files being evicted first. Cached responses are shared, so
+    callers must not modify them.
+    """
+
+    def __init__(
+        self, folder, memoryEntries=DEFAULT_MEMORY_ENTRIES, diskSize=DEFAULT_DISK_SIZE
+    ):
+        self.folder = folder
+        self.memoryEntries = memoryEntries
+        self.diskSize = diskSize
+        self.enabled = True
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._diskUsage = None
+
+    @staticmethod
+    def key(action, params, package):
+        """
+        Canonical key of a request: a hash of the action, the request body
+        with sorted keys and the map package it is computed on.
+        """
+        canonical = json.dumps(
+            {"action": action, "params": params, "package": package},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                LOG.info("Response cache hit (memory) %s" % key)
+                return self.memory[key]
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                response = json.load(f)
+            # Keep track of the last use for the disk eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            LOG.info("Response cache miss %s" % key)
+            return None
+        with self.lock:
+            self.hits += 1
+            self._putInMemory(key, response)
+        LOG.info("Response cache hit (disk) %s" % key)
+        return response
+
+    def put(self, key, response):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._putInMemory(key, response)
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._path(key)
+        tmpPath = "%s.%s.tmp" % (path, threading.get_ident())
+        try:
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                json.dump(response, f)
+            size = os.path.getsize(tmpPath)
+            os.replace(tmpPath, path)
+        except OSError as e:
+            LOG.warning("Could not write cached response %s: %s" % (key, e))
+            return
+        with self.lock:
+            if self._diskUsage is not None:
+                self._diskUsage += size
+            self._evictFromDisk()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            for path in self._diskFiles():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._diskUsage = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".json")
+
+    def _putInMemory(self, key, response):
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memoryEntries:
+            evicted, _ = self.memory.popitem(last=False)
+            self.evictions += 1
+            LOG.info("Response cache eviction (memory) %s" % evicted)
+
+    def _diskFiles(self):
+        try:
+            return [
+                os.path.join(self.folder, name)
+                for name in os.listdir(self.folder)
+                if name.endswith(".json")
+            ]
+        except OSError:
+            return []
+
+    def _evictFromDisk(self):
+        if self._diskUsage is not None and self._diskUsage <= self.diskSize:
+            return
+        files = []
+        for path in self._diskFiles():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        self._diskUsage = sum(f[1] for f in files)
+        files.sort()
+        while files and self._diskUsage > self.diskSize:
+            _, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._diskUsage -= size
+            self.evictions += 1
+            LOG.info("Response cache eviction (disk) %s" % os.path.basename(path))
@@ -2,10 +2,15 @@
 
 # Code partially adapted from the QGIS - Valhalla plugin by Nils Nolde(nils@gis-ops.com)
 import logging
-from kadasrouting.exceptions import ValhallaException, Valhalla400Exception
+
+from qgis.core import QgsApplication
+
+from kadasrouting.exceptions import ValhallaException
 from kadasrouting.utilities import encodePolyline6
 
-from .connectors import ConsoleConnector
+from .connectors import connectorFromSettings
+from .tasks import ValhallaTask, ValhallaBatchTask, runMany, currentTask, checkCanceled
+from . import trace
 
 LOG = logging.getLogger(__name__)
 
@@ -24,11 +29,17 @@ class ValhallaClient:
         if ValhallaClient.__instance is not None:
             raise Exception("Singleton class")
         ValhallaClient.__instance = self
-        self.connector = connector or ConsoleConnector()
+        self.connector = connector or connectorFromSettings()
+        # References to running tasks, they must outlive the python wrapper
+        self._tasks = set()
 
     def isAvailable(self):
         return self.connector.isAvailable()
 
+    def shutdown(self):
+        """Stop any long-lived valhalla process owned by the connector"""
+        self.connector.shutdown()
+
     def route(self, qgspoints, profile, avoid_polygons, options, patrol_polygons=None):
         """
         Computes a route
@@ -56,37 +67,244 @@ class ValhallaClient:
             response = self.connector.route(
                 points, profile, avoid_polygons, options, patrol_polygons
             )
+        except ValhallaException as e:
+            raise e
+        except Exception as e:
+            raise ValhallaException(str(e))
+        return response
+
+    def optimizedRoute(self, qgspoints, profile, avoid_polygons, options):
+        """
+        Computes a route through all the points, visiting the intermediate
+        ones in the order that minimizes the travel cost. The first and the
+        last points are kept in place.
+
+        The parameters are the same as for route. Use optimizedOrder to get
+        the order of the points in the response.
+        """
+        points = self.pointsFromQgsPoints(qgspoints)
+        try:
+            response = self.connector.optimizedRoute(
+                points, profile, avoid_polygons, options
+            )
+        except ValhallaException as e:
+            raise e
         except Exception as e:
             raise ValhallaException(str(e))
         return response
 
+    @staticmethod
+    def optimizedOrder(response):
+        """
+        Return the indices, in the request, of the locations of an
+        optimized route response, in visiting order.
+        """
+        return [
+            location["original_index"] for location in response["trip"]["locations"]
+        ]
+
     def isochrones(self, qgspoint, profile, costingOptions, intervals, colors):
         points = self.pointsFromQgsPoints([qgspoint])
         try:
             response = self.connector.isochrones(
                 points, profile, costingOptions, intervals, colors
             )
-        except Valhalla400Exception as e:
+        except ValhallaException as e:
+            raise e
+        except Exception as e:
+            raise ValhallaException(str(e))
+        return response
+
+    def matrix(self, sources, targets, profile, costingOptions):
+        """
+        Computes the time and distance from each source to each target
+
+        :param sources: QgsPointXY in epsg4326 crs
+        :type sources: list
+
+        :param targets: QgsPointXY in epsg4326 crs
+        :type targets: list
+
+        :returns: The valhalla sources_to_targets response. Its
+            sources_to_targets item has one row per source, with one
+            {"time", "distance"} dict per target. Unreachable targets
+            have a null time and distance.
+        :rtype: dict
+        """
+        try:
+            response = self.connector.matrix(
+                self.pointsFromQgsPoints(sources),
+                self.pointsFromQgsPoints(targets),
+                profile,
+                costingOptions,
+            )
+        except ValhallaException as e:
             raise e
         except Exception as e:
             raise ValhallaException(str(e))
         return response
 
     def mapmatching(self, line, profile, costingOptions):
+        """
+        Match a line to the road network. Long lines are split into
+        overlapping chunks, matched in parallel and joined into one route.
+        Within a batch (see traceMany), the chunks are matched one after
+        the other, by the thread of the batch.
+        """
+        points = [(pt.y(), pt.x()) for pt in line]
+        maxPoints, maxDistance = trace.chunkLimits()
+        chunks = trace.splitTrace(points, maxPoints, maxDistance)
+        if len(chunks) == 1:
+            return self._mapmatchingPoints(points, profile, costingOptions)
+        LOG.debug("Map matching %d points in %d chunks" % (len(points), len(chunks)))
+        requests = [
+            (points[first:last + 1], profile, costingOptions) for first, last in chunks
+        ]
+        responses = [None] * len(chunks)
+        for i, response, error in runMany(
+            self._mapmatchingPoints, requests, task=currentTask()
+        ):
+            if error is not None:
+                raise error
+            responses[i] = response
+        checkCanceled()
+        return trace.stitchResponses(responses, points, chunks)
+
+    def _mapmatchingPoints(self, points, profile, costingOptions):
         try:
-            pt = line[0]
-            shape = [{"lat": pt.y(), "lon": pt.x(), "type": "break"}]
-            for pt in line[1:-1]:
-                shape.append({"lat": pt.y(), "lon": pt.x(), "type": "via"})
-            pt = line[-1]
-            shape.append({"lat": pt.y(), "lon": pt.x(), "type": "break"})
+            lat, lon = points[0]
+            shape = [{"lat": lat, "lon": lon, "type": "break"}]
+            for lat, lon in points[1:-1]:
+                shape.append({"lat": lat, "lon": lon, "type": "via"})
+            lat, lon = points[-1]
+            shape.append({"lat": lat, "lon": lon, "type": "break"})
             response = self.connector.mapmatching(shape, profile, costingOptions)
-        except Valhalla400Exception as e:
+        except ValhallaException as e:
             raise e
         except Exception as e:
             raise ValhallaException(str(e))
         return response
 
+    def routeMany(self, requests, workers=None):
+        """
+        Compute many routes in parallel.
+
+        :param requests: The arguments of route for each route, either as a
+            tuple (qgspoints, profile, avoid_polygons, options) or as a dict
+        :type requests: list
+
+        :param workers: Number of routes computed in parallel, the
+            /kadasrouting/batchWorkers setting if None
+        :type workers: int
+
+        :returns: A generator of (index, response, error) tuples, yielded as
+            soon as each route is done, index being the position of the
+            request. error is the ValhallaException raised, or None.
+        """
+        return runMany(self.route, requests, workers)
+
+    def isochronesMany(self, requests, workers=None):
+        """Same as routeMany, for isochrones requests"""
+        return runMany(self.isochrones, requests, workers)
+
+    def traceMany(self, requests, workers=None):
+        """Same as routeMany, for mapmatching requests"""
+        return runMany(self.mapmatching, requests, workers)
+
+    def runAsync(self, description, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) in a QgsTask and return the task.
+
+        Connect to the task responseReady and requestFailed signals to get
+        the result, and call cancel() on it to abandon the request.
+
+        :rtype: ValhallaTask
+        """
+        task = ValhallaTask(description, function, *args, **kwargs)
+        return self._submit(task)
+
+    def _submit(self, task):
+        self._tasks.add(task)
+
+        def _release():
+            self._tasks.discard(task)
+
+        task.taskCompleted.connect(_release)
+        task.taskTerminated.connect(_release)
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def routeAsync(
+        self, qgspoints, profile, avoid_polygons, options, patrol_polygons=None
+    ):
+        """Same as route, computed in the background. Returns a ValhallaTask"""
+        return self.runAsync(
+            "Routing",
+            self.route,
+            qgspoints,
+            profile,
+            avoid_polygons,
+            options,
+            patrol_polygons,
+        )
+
+    def optimizedRouteAsync(self, qgspoints, profile, avoid_polygons, options):
+        """Same as optimizedRoute, computed in the background. Returns a ValhallaTask"""
+        return self.runAsync(
+            "Optimized routing",
+            self.optimizedRoute,
+            qgspoints,
+            profile,
+            avoid_polygons,
+            options,
+        )
+
+    def isochronesAsync(self, qgspoint, profile, costingOptions, intervals, colors):
+        """Same as isochrones, computed in the background. Returns a ValhallaTask"""
+        return self.runAsync(
+            "Reachability",
+            self.isochrones,
+            qgspoint,
+            profile,
+            costingOptions,
+            intervals,
+            colors,
+        )
+
+    def mapmatchingAsync(self, line, profile, costingOptions):
+        """Same as mapmatching, computed in the background. Returns a ValhallaTask"""
+        return self.runAsync(
+            "Map matching", self.mapmatching, line, profile, costingOptions
+        )
+
+    def runBatchAsync(self, description, function, requests, workers=None):
+        """
+        Run function once per request in a QgsTask and return the task.
+
+        Connect to the task itemFinished signal to get each result as soon
+        as it is done, and to progressChanged to follow the batch.
+
+        :rtype: ValhallaBatchTask
+        """
+        task = ValhallaBatchTask(description, function, requests, workers)
+        return self._submit(task)
+
+    def routeManyAsync(self, requests, workers=None):
+        """Same as routeMany, computed in the background. Returns a ValhallaBatchTask"""
+        return self.runBatchAsync("Batch routing", self.route, requests, workers)
+
+    def isochronesManyAsync(self, requests, workers=None):
+        """Same as isochronesMany, computed in the background. Returns a ValhallaBatchTask"""
+        return self.runBatchAsync(
+            "Batch reachability", self.isochrones, requests, workers
+        )
+
+    def traceManyAsync(self, requests, workers=None):
+        """Same as traceMany, computed in the background. Returns a ValhallaBatchTask"""
+        return self.runBatchAsync(
+            "Batch map matching", self.mapmatching, requests, workers
+        )
+
     def polyline6fromQgsPolylineXY(self, qgsline):
         points = [(p.x(), p.y()) for p in qgsline]
         encoded = encodePolyline6(points)
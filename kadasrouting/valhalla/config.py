@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from jinja2 import Environment, FileSystemLoader
+
+from qgis.core import QgsSettings
+
+from kadasrouting.utilities import appDataDir, tr
+from kadasrouting.core.datacatalogueclient import DataCatalogueClient
+from kadasrouting.core.tileextract import TILES_DIR_NAME, TILE_EXTRACT_NAME
+from kadasrouting.valhalla.performance import cacheSettings
+
+LOG = logging.getLogger(__name__)
+
+
+class ValhallaConfig:
+    """
+    Renders valhalla.json for the active map package.
+
+    The configuration is rendered once per tiles ID, package timestamp and
+    template variables, and kept both in memory and on disk. Later calls
+    only compare the active tiles ID and the modification time of the
+    package metadata with the cached ones.
+    """
+
+    __instance = None
+
+    @staticmethod
+    def getInstance():
+        if ValhallaConfig.__instance is None:
+            ValhallaConfig()
+        return ValhallaConfig.__instance
+
+    def __init__(self):
+        if ValhallaConfig.__instance is not None:
+            raise Exception("Singleton class")
+        ValhallaConfig.__instance = self
+        templateFileLoader = FileSystemLoader(os.path.dirname(__file__))
+        jinjaEnv = Environment(loader=templateFileLoader)
+        self.template = jinjaEnv.get_template("valhalla.json.jinja")
+        self.path = os.path.join(appDataDir(), "valhalla.json")
+        self.lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        self._key = None
+        self._tilesID = None
+        self._values = None
+        self._written = None
+
+    def configFor(self, **content):
+        """
+        Return the configuration for the active map package, rendering it
+        only if the package or the template variables have changed.
+
+        The tile cache settings of the active performance profile are part
+        of the template variables, so changing profile renders it again.
+
+        :param content: Additional template variables
+        :type content: dict
+
+        :returns: The active tiles ID and the path to valhalla.json
+        :rtype: tuple
+        """
+        activeValhallaTilesID = QgsSettings().value(
+            "/kadasrouting/activeValhallaTilesID"
+        )
+        if not activeValhallaTilesID:
+            message = tr(
+                "No map package selected. Please open data catalogue, and select a map package."
+            )
+            raise Exception(message)
+        content = dict(cacheSettings(), **content)
+        key = (
+            activeValhallaTilesID,
+            self._packageVersion(activeValhallaTilesID),
+            self._contentHash(content),
+        )
+        with self.lock:
+            if key != self._key:
+                self._render(activeValhallaTilesID, content)
+                self._key = key
+            return self._tilesID, self.path
+
+    def activePackage(self):
+        """
+        Return the active tiles ID and the version of the installed package,
+        without rendering the configuration. Both are None if no package is
+        selected.
+        """
+        activeValhallaTilesID = QgsSettings().value(
+            "/kadasrouting/activeValhallaTilesID"
+        )
+        if not activeValhallaTilesID:
+            return None, None
+        return activeValhallaTilesID, self._packageVersion(activeValhallaTilesID)
+
+    def configKey(self):
+        """Identifies the rendered package, its version and the template
+        variables, None if not rendered yet"""
+        return self._key
+
+    def values(self):
+        """The rendered configuration as a dict, None if not rendered yet"""
+        return self._values
+
+    def serviceLimit(self, profile, name, default):
+        """
+        Return a service limit of the rendered configuration, e.g.
+        max_matrix_locations, or default if it is not rendered yet.
+        """
+        limits = (self._values or {}).get("service_limits", {})
+        return limits.get(profile, {}).get(name, default)
+
+    def _render(self, activeValhallaTilesID, content):
+        folder = DataCatalogueClient.folderForDataItem(activeValhallaTilesID)
+        # Needed since they will be stored in a json file
+        valhallaTilesDir = os.path.join(folder, TILES_DIR_NAME).replace("\\", "/")
+        valhallaTileExtract = os.path.join(folder, TILE_EXTRACT_NAME).replace(
+            "\\", "/"
+        )
+        if not os.path.exists(valhallaTileExtract):
+            valhallaTileExtract = ""
+        LOG.debug("using tiles in %s" % (valhallaTileExtract or valhallaTilesDir))
+        if not valhallaTileExtract and not os.path.exists(valhallaTilesDir):
+            message = tr("No map package on this directory: {directory}").format(
+                directory=valhallaTilesDir
+            )
+            raise Exception(message)
+        variables = dict(content)
+        variables["valhallaTilesDir"] = valhallaTilesDir
+        variables["valhallaTileExtract"] = valhallaTileExtract
+        rendered = self.template.render(**variables)
+        if rendered != self._written or not os.path.exists(self.path):
+            LOG.info("Write valhalla config for %s" % activeValhallaTilesID)
+            with open(self.path, "w") as f:
+                f.write(rendered)
+            self._written = rendered
+        self._values = json.loads(rendered)
+        self._tilesID = activeValhallaTilesID
+
+    @staticmethod
+    def _packageVersion(itemid):
+        # The metadata file is rewritten whenever the package is installed
+        # or updated, so its modification time tracks the package timestamp
+        if not itemid:
+            return None
+        metadata = os.path.join(DataCatalogueClient.folderForDataItem(itemid), "metadata")
+        try:
+            return os.stat(metadata).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _contentHash(content):
+        return hashlib.sha1(
+            json.dumps(content, sort_keys=True).encode("utf-8")
+        ).hexdigest()
@@ -1,23 +1,134 @@
 import os
+import time
 import subprocess
+import threading
 import logging
 import json
-from jinja2 import Environment, FileSystemLoader
+import tempfile
+import http.client
+from urllib.parse import urlparse
 
 from PyQt5.QtCore import QObject
 
 from qgis.core import QgsSettings
 
-from kadasrouting.utilities import localeName, appDataDir, pushWarning
-from kadasrouting.core.datacatalogueclient import DataCatalogueClient
+from kadasrouting.utilities import localeName, appDataDir
+from kadasrouting.exceptions import Valhalla400Exception, ValhallaCanceledException
+from kadasrouting.valhalla.cache import (
+    ResponseCache,
+    DEFAULT_MEMORY_ENTRIES,
+    DEFAULT_DISK_SIZE,
+)
+from kadasrouting.valhalla.config import ValhallaConfig
+from kadasrouting.valhalla.httppool import HttpConnectionPool
+from kadasrouting.valhalla.tasks import checkCanceled
 
 LOG = logging.getLogger(__name__)
 
+CONSOLE_CONNECTOR = "console"
+HTTP_CONNECTOR = "http"
+
+DEFAULT_HTTP_URL = "http://127.0.0.1:8002"
+DEFAULT_HTTP_POOL_SIZE = 4
+# Seconds to wait for a freshly started valhalla_service to answer
+HTTP_SERVICE_START_TIMEOUT = 30
+# Seconds to wait for an answer when checking if the service is up
+HTTP_STATUS_TIMEOUT = 2
+# Seconds between checks for cancellation while valhalla_service runs
+CANCEL_POLL_INTERVAL = 0.1
+
+
+def connectorFromSettings():
+    """
+    Create the connector selected in /kadasrouting/valhalla_connector. The
+    default HTTP connector keeps one valhalla_service running, the console
+    connector starts one for every request.
+    """
+    connectorType = QgsSettings().value(
+        "/kadasrouting/valhalla_connector", HTTP_CONNECTOR
+    )
+    if connectorType == HTTP_CONNECTOR:
+        return HttpConnector()
+    return ConsoleConnector()
+
+
+def runProcess(commands, cwd):
+    """
+    Run a command and return its (stdout, stderr), killing it if the task
+    running in the calling thread is canceled.
+
+    The command is started without a shell, so that killing it stops the
+    command itself and not just a shell wrapping it, which would keep its
+    output pipes open until the command is done.
+    """
+    process = subprocess.Popen(
+        commands,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+    )
+    while True:
+        try:
+            return process.communicate(timeout=CANCEL_POLL_INTERVAL)
+        except subprocess.TimeoutExpired:
+            try:
+                checkCanceled()
+            except ValhallaCanceledException:
+                process.kill()
+                process.communicate()
+                raise
+
 
 class Connector(QObject):
+    def __init__(self):
+        super().__init__()
+        settings = QgsSettings()
+        self.cache = ResponseCache(
+            os.path.join(appDataDir(), "cache"),
+            memoryEntries=settings.value(
+                "/kadasrouting/responseCache/memoryEntries",
+                DEFAULT_MEMORY_ENTRIES,
+                type=int,
+            ),
+            diskSize=settings.value(
+                "/kadasrouting/responseCache/diskSizeMB",
+                DEFAULT_DISK_SIZE // (1024 * 1024),
+                type=int,
+            )
+            * 1024
+            * 1024,
+        )
+        self.cache.enabled = settings.value(
+            "/kadasrouting/responseCache/enabled", True, type=bool
+        )
+
     def isAvailable(self):
         return True
 
+    def _cached(self, action, params, execute):
+        """
+        Return the cached response for a request, calling execute() and
+        caching its response on a miss. The key includes the active map
+        package and its version, so a new package never gets stale routes.
+        """
+        key = ResponseCache.key(
+            action, params, ValhallaConfig.getInstance().activePackage()
+        )
+        response = self.cache.get(key)
+        if response is None:
+            response = execute()
+            if self._canCache():
+                self.cache.put(key, response)
+        return response
+
+    def _canCache(self):
+        """Whether the last response was computed with the active package"""
+        return True
+
+    def shutdown(self):
+        pass
+
     def prepareRouteParameters(
         self,
         points,
@@ -49,10 +160,9 @@ class Connector(QObject):
         travel_constraint = "distance" if options.get('shortest') else "time"
         # build contour json
         if len(intervals) != len(colors):
-            pushWarning(
-                self.tr(
-                    "The number of intervals and colors are different, using default color"
-                )
+            # This may run in a background task, the caller warns the user
+            LOG.warning(
+                "The number of intervals and colors are different, using default color"
             )
             contours = [{travel_constraint: x} for x in intervals]
         else:
@@ -68,6 +178,12 @@ class Connector(QObject):
         )
         return params
 
+    def prepareMatrixParameters(self, sources, targets, profile, options):
+        params = dict(costing=profile, sources=sources, targets=targets)
+        if options:
+            params["costing_options"] = {profile: options}
+        return params
+
     def prepareMapmatchingParameters(self, shape, profile, options):
         return {
             "shape": shape,
@@ -82,77 +198,51 @@ class ConsoleConnector(Connector):
         return os.path.exists(self._valhallaExecutablePath())
 
     def createMapmatchingParametersFile(self, params):
-        outputFileName = os.path.join(appDataDir(), "params.json")
-        with open(outputFileName, "w") as f:
+        # One file per request, so that concurrent requests do not clash
+        fd, outputFileName = tempfile.mkstemp(
+            prefix="params_", suffix=".json", dir=appDataDir()
+        )
+        with os.fdopen(fd, "w") as f:
             json.dump(params, f)
         return outputFileName
 
-    def createValhallaJsonConfig(self, content):
-        outputFileName = os.path.join(appDataDir(), "valhalla.json")
-        templatePath = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)), "valhalla"
-        )
-        templateFileLoader = FileSystemLoader(templatePath)
-        jinjaEnv = Environment(loader=templateFileLoader)
-        valhallaConfigTemplate = jinjaEnv.get_template("valhalla.json.jinja")
-        with open(outputFileName, "w") as f:
-            f.write(
-                valhallaConfigTemplate.render(
-                    valhallaTilesDir=content["valhallaTilesDir"]
-                )
-            )
-        return outputFileName
-
-    def _valhallaExecutablePath(self):
+    def _valhallaExecutableDir(self):
         kadasFolder = os.path.join(os.environ["PROGRAMFILES"], "KadasAlbireo")
         defaultValhallaExeDir = os.path.join(kadasFolder, "opt", "routing")
-        valhallaPath = QgsSettings().value(
+        return QgsSettings().value(
             "/kadasrouting/valhalla_exe_dir", defaultValhallaExeDir
         )
-        return os.path.join(valhallaPath, "valhalla_service.exe")
 
-    def _execute(self, action, request):
-        defaultValhallaExeDir = r"C:/Program Files/KadasAlbireo/opt/routing"
-        valhallaPath = QgsSettings().value(
-            "/kadasrouting/valhalla_exe_dir", defaultValhallaExeDir
-        )
-        valhallaExecutable = os.path.join(valhallaPath, "valhalla_service.exe")
+    def _valhallaExecutablePath(self):
+        return os.path.join(self._valhallaExecutableDir(), "valhalla_service.exe")
 
-        activeValhallaTilesID = QgsSettings().value(
-            "/kadasrouting/activeValhallaTilesID"
-        )
+    def _prepareValhallaConfig(self, **content):
+        """
+        Return the active tiles ID and the path to the valhalla config
+        rendered for it.
+        """
+        return ValhallaConfig.getInstance().configFor(**content)
 
-        if not activeValhallaTilesID:
-            message = self.tr(
-                "No map package selected. Please open data catalogue, and select a map package."
-            )
-            raise Exception(message)
-
-        valhallaTilesDir = os.path.join(
-            DataCatalogueClient.folderForDataItem(activeValhallaTilesID),
-            "valhalla_tiles",
-        )
-        # Needed since it will be stored in a json file
-        valhallaTilesDir = valhallaTilesDir.replace("\\", "/")
-        LOG.debug("using tiles in %s" % valhallaTilesDir)
-        if not os.path.exists(valhallaTilesDir):
-            message = self.tr("No map package on this directory: {directory}").format(
-                directory=valhallaTilesDir
-            )
-            raise Exception(message)
+    def _execute(self, action, params):
+        if action == "trace_route":
+            # A long trace does not fit in the command line
+            filename = self.createMapmatchingParametersFile(params)
+            try:
+                return self._executeCommand(action, filename)
+            finally:
+                os.remove(filename)
+        return self._executeCommand(action, json.dumps(params))
 
-        os.chdir(valhallaPath)
-        valhallaConfig = self.createValhallaJsonConfig(
-            {"valhallaTilesDir": valhallaTilesDir}
-        )
+    def _executeCommand(self, action, request):
+        valhallaPath = self._valhallaExecutableDir()
+        valhallaExecutable = self._valhallaExecutablePath()
+        _, valhallaConfig = self._prepareValhallaConfig()
         commands = [valhallaExecutable, valhallaConfig, action, request]
         LOG.info("Run %s" % commands)
-        result = subprocess.run(
-            commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True
-        )
-        LOG.info(result.stdout)
-        LOG.error(result.stderr)
-        response = json.loads(result.stdout.decode("utf-8"))
+        stdout, stderr = runProcess(commands, valhallaPath)
+        LOG.info(stdout)
+        LOG.error(stderr)
+        response = json.loads(stdout.decode("utf-8"))
         if "error" in response:
             LOG.error(response["error"])
             raise Exception(response["error"])
@@ -165,21 +255,205 @@ class ConsoleConnector(Connector):
         # Add handling for chinese_postman if there is a patrol_polygon
         if patrol_polygon:
             LOG.debug('patrol polygon')
-            response = self._execute("chinese_postman", json.dumps(params))
+            action = "chinese_postman"
         else:
             LOG.debug('route')
-            response = self._execute("route", json.dumps(params))
-        return response
+            action = "route"
+        return self._cached(action, params, lambda: self._execute(action, params))
+
+    def optimizedRoute(self, points, profile, avoid_polygons, options):
+        params = self.prepareRouteParameters(points, profile, avoid_polygons, options)
+        return self._cached(
+            "optimized_route",
+            params,
+            lambda: self._execute("optimized_route", params),
+        )
 
     def isochrones(self, points, profile, options, intervals, colors):
         params = self.prepareIsochronesParameters(
             points, profile, options, intervals, colors
         )
-        response = self._execute("isochrone", json.dumps(params))
-        return response
+        return self._cached(
+            "isochrone", params, lambda: self._execute("isochrone", params)
+        )
+
+    def matrix(self, sources, targets, profile, options):
+        params = self.prepareMatrixParameters(sources, targets, profile, options)
+        return self._cached(
+            "sources_to_targets",
+            params,
+            lambda: self._execute("sources_to_targets", params),
+        )
 
     def mapmatching(self, shape, profile, options):
         params = self.prepareMapmatchingParameters(shape, profile, options)
-        filename = self.createMapmatchingParametersFile(params)
-        response = self._execute("trace_route", filename)
+        return self._cached(
+            "trace_route", params, lambda: self._execute("trace_route", params)
+        )
+
+
+class HttpConnector(ConsoleConnector):
+    """
+    Connector that talks to a valhalla_service running in HTTP mode on this
+    workstation, at the URL set in /kadasrouting/valhalla_http_url.
+
+    If nothing answers on that URL, the local valhalla_service is started
+    in HTTP mode with the active map package and kept running, so that all
+    the features of the plugin (and other users of the same workstation)
+    share one warm routing engine. It is started again if it stops, and
+    replaced when the active package changes. Requests go through a pool of
+    keep-alive connections.
+
+    If the service cannot be started, requests run valhalla_service once
+    each, as with the console connector, until the active package changes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        url = urlparse(
+            QgsSettings().value("/kadasrouting/valhalla_http_url", DEFAULT_HTTP_URL)
+        )
+        self.host = url.hostname or "127.0.0.1"
+        self.port = url.port or 8002
+        self.poolSize = QgsSettings().value(
+            "/kadasrouting/valhalla_http_pool_size", DEFAULT_HTTP_POOL_SIZE, type=int
+        )
+        self.pool = HttpConnectionPool(self.host, self.port, self.poolSize)
+        self._service = None
+        self._serviceConfig = None
+        # Configuration the service could not be started with
+        self._failedConfig = None
+        self._externalService = False
+        # Package active when the external service was found, and whether
+        # it has changed since
+        self._externalPackage = None
+        self._externalStale = False
+        self._serviceLock = threading.Lock()
+
+    def isAvailable(self):
+        return self._isServiceUp() or super().isAvailable()
+
+    def _isServiceUp(self):
+        # Not through the pool: the check must fail fast, it runs when the
+        # plugin is loaded
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=HTTP_STATUS_TIMEOUT
+        )
+        try:
+            connection.request("GET", "/status")
+            return connection.getresponse().status == 200
+        except (http.client.HTTPException, OSError):
+            return False
+        finally:
+            connection.close()
+
+    def _ensureService(self):
+        """
+        Make sure a valhalla service answers on the URL, starting the local
+        one if needed. Return False if it could not be started.
+        """
+        with self._serviceLock:
+            package = ValhallaConfig.getInstance().activePackage()
+            if self._externalService:
+                stale = package != self._externalPackage
+                if stale and not self._externalStale:
+                    LOG.warning(
+                        "The active map package has changed, but the valhalla "
+                        "service on %s:%s was not started by KADAS and keeps "
+                        "its own. Restart it with the new package. Its "
+                        "responses are not cached meanwhile." % (self.host, self.port)
+                    )
+                self._externalStale = stale
+                return True
+            _, valhallaConfig = self._prepareValhallaConfig(
+                httpListen="tcp://%s:%s" % (self.host, self.port)
+            )
+            configKey = ValhallaConfig.getInstance().configKey()
+            if self._service is not None:
+                if self._service.poll() is None and self._serviceConfig == configKey:
+                    return True
+                self._stopService()
+            if self._isServiceUp():
+                LOG.info(
+                    "Using the valhalla service already running on %s:%s"
+                    % (self.host, self.port)
+                )
+                self._externalService = True
+                self._externalPackage = package
+                self._externalStale = False
+                return True
+            if self._failedConfig == configKey:
+                return False
+            try:
+                self._startService(configKey, valhallaConfig)
+            except Exception as e:
+                LOG.warning(
+                    "%s, running valhalla_service for every request instead" % e
+                )
+                self._failedConfig = configKey
+                return False
+            return True
+
+    def _startService(self, configKey, valhallaConfig):
+        commands = [self._valhallaExecutablePath(), valhallaConfig, str(self.poolSize)]
+        LOG.info("Start valhalla service %s" % commands)
+        self._service = subprocess.Popen(
+            commands,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=self._valhallaExecutableDir(),
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        )
+        self._serviceConfig = configKey
+        deadline = time.monotonic() + HTTP_SERVICE_START_TIMEOUT
+        while not self._isServiceUp():
+            if self._service.poll() is not None or time.monotonic() > deadline:
+                self._stopService()
+                raise Exception(self.tr("Could not start the valhalla service"))
+            time.sleep(0.2)
+
+    def _stopService(self):
+        if self._service is not None:
+            LOG.info("Stop valhalla service")
+            self._service.terminate()
+            try:
+                self._service.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._service.kill()
+        self._service = None
+        self._serviceConfig = None
+        self.pool.close()
+
+    def shutdown(self):
+        with self._serviceLock:
+            self._stopService()
+            self._externalService = False
+            self._externalStale = False
+            self._failedConfig = None
+
+    def _canCache(self):
+        return not (self._externalService and self._externalStale)
+
+    def _execute(self, action, params):
+        if not self._ensureService():
+            return super()._execute(action, params)
+        checkCanceled()
+        LOG.info("POST /%s to %s:%s" % (action, self.host, self.port))
+        try:
+            status, body = self.pool.request(
+                "POST", "/" + action, json.dumps(params).encode("utf-8")
+            )
+        except (http.client.HTTPException, OSError):
+            # The service went away, look for it (or start it) again next time
+            with self._serviceLock:
+                self._externalService = False
+            raise
+        content = body.decode("utf-8")
+        if status == 400:
+            LOG.error(content)
+            raise Valhalla400Exception(content)
+        response = json.loads(content)
+        if "error" in response:
+            LOG.error(response["error"])
+            raise Exception(response["error"])
         return response
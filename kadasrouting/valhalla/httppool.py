@@ -0,0 +1,62 @@
+import queue
+import logging
+import http.client
+
+LOG = logging.getLogger(__name__)
+
+
+class HttpConnectionPool:
+    """
+    Fixed size pool of keep-alive HTTP connections to a single host.
+
+    Connections are created lazily and reused across requests. A caller
+    blocks until a connection is available, so at most `size` requests are
+    in flight at the same time. A connection that fails is dropped and the
+    request is retried once on a new one, since the server may have closed
+    an idle keep-alive connection.
+    """
+
+    def __init__(self, host, port, size=4, timeout=300):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._connections = queue.LifoQueue()
+        for _ in range(max(1, size)):
+            self._connections.put(None)
+
+    def request(self, method, path, body=None):
+        """
+        Send a request and return a (status, body) tuple, body being bytes
+        """
+        connection = self._connections.get()
+        try:
+            for attempt in range(2):
+                if connection is None:
+                    connection = http.client.HTTPConnection(
+                        self.host, self.port, timeout=self.timeout
+                    )
+                try:
+                    headers = {"Content-Type": "application/json"}
+                    connection.request(method, path, body=body, headers=headers)
+                    response = connection.getresponse()
+                    return response.status, response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    LOG.debug("HTTP connection to %s failed: %s" % (self.host, e))
+                    connection.close()
+                    connection = None
+                    if attempt:
+                        raise
+        finally:
+            self._connections.put(connection)
+
+    def close(self):
+        connections = []
+        while True:
+            try:
+                connections.append(self._connections.get_nowait())
+            except queue.Empty:
+                break
+        for connection in connections:
+            if connection is not None:
+                connection.close()
+            self._connections.put(None)
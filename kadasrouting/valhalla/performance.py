@@ -0,0 +1,96 @@
+import os
+import logging
+
+from qgis.core import QgsSettings
+
+LOG = logging.getLogger(__name__)
+
+LOW_MEMORY = "low_memory"
+BALANCED = "balanced"
+THROUGHPUT = "throughput"
+CUSTOM = "custom"
+
+DEFAULT_PROFILE = BALANCED
+
+# Valhalla mjolnir tile cache settings for each performance profile.
+# Valhalla uses an LRU cache when use_lru_mem_cache is set, a cache that is
+# cleared when full when use_simple_mem_cache is set, and a flat cache
+# otherwise. max_cache_size is in bytes.
+PROFILES = {
+    LOW_MEMORY: {
+        "useLruMemCache": True,
+        "useSimpleMemCache": False,
+        "maxCacheSize": 256 * 1024 * 1024,
+        "maxConcurrentReaderUsers": 1,
+    },
+    # Settings used before profiles were configurable
+    BALANCED: {
+        "useLruMemCache": False,
+        "useSimpleMemCache": False,
+        "maxCacheSize": 1000000000,
+        "maxConcurrentReaderUsers": 1,
+    },
+    THROUGHPUT: {
+        "useLruMemCache": False,
+        "useSimpleMemCache": True,
+        "maxCacheSize": 4 * 1024 * 1024 * 1024,
+        "maxConcurrentReaderUsers": os.cpu_count() or 1,
+    },
+}
+
+
+def profileNames():
+    return [LOW_MEMORY, BALANCED, THROUGHPUT, CUSTOM]
+
+
+def activeProfile():
+    profile = QgsSettings().value("/kadasrouting/performanceProfile", DEFAULT_PROFILE)
+    if profile not in profileNames():
+        LOG.warning("Unknown performance profile %s, using %s" % (profile, DEFAULT_PROFILE))
+        profile = DEFAULT_PROFILE
+    return profile
+
+
+def setActiveProfile(profile):
+    QgsSettings().setValue("/kadasrouting/performanceProfile", profile)
+
+
+def cacheSettings(profile=None):
+    """
+    Return the valhalla.json template variables for a performance profile.
+
+    The custom profile reads each value from
+    /kadasrouting/performance/<name>, using the balanced values as defaults.
+
+    :param profile: The profile name, the active one if None
+    :type profile: str
+
+    :rtype: dict
+    """
+    profile = profile or activeProfile()
+    if profile != CUSTOM:
+        return dict(PROFILES[profile])
+    settings = QgsSettings()
+    defaults = PROFILES[BALANCED]
+    return {
+        "useLruMemCache": settings.value(
+            "/kadasrouting/performance/useLruMemCache",
+            defaults["useLruMemCache"],
+            type=bool,
+        ),
+        "useSimpleMemCache": settings.value(
+            "/kadasrouting/performance/useSimpleMemCache",
+            defaults["useSimpleMemCache"],
+            type=bool,
+        ),
+        "maxCacheSize": settings.value(
+            "/kadasrouting/performance/maxCacheSize",
+            defaults["maxCacheSize"],
+            type=int,
+        ),
+        "maxConcurrentReaderUsers": settings.value(
+            "/kadasrouting/performance/maxConcurrentReaderUsers",
+            defaults["maxConcurrentReaderUsers"],
+            type=int,
+        ),
+    }
@@ -0,0 +1,205 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PyQt5.QtCore import pyqtSignal
+
+from qgis.core import QgsTask, QgsSettings
+
+from kadasrouting.exceptions import ValhallaCanceledException
+
+LOG = logging.getLogger(__name__)
+
+_current = threading.local()
+
+
+def currentTask():
+    """The ValhallaTask running in the calling thread, if any"""
+    return getattr(_current, "task", None)
+
+
+def runAs(task, function, *args, **kwargs):
+    """Call function with task as the task running in the calling thread"""
+    previous = currentTask()
+    _current.task = task
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _current.task = previous
+
+
+def inBatch():
+    """Whether the calling thread is running a request of runMany"""
+    return getattr(_current, "batch", False)
+
+
+def batchWorkers():
+    """
+    Number of requests of a batch run in parallel, set in
+    /kadasrouting/batchWorkers and defaulting to the number of CPU cores.
+    """
+    workers = QgsSettings().value(
+        "/kadasrouting/batchWorkers", os.cpu_count() or 1, type=int
+    )
+    return max(1, workers)
+
+
+def runMany(function, requests, workers=None, task=None):
+    """
+    Call function once per request on a pool of threads, and yield an
+    (index, response, error) tuple for each request as soon as it is done.
+
+    A request is either a tuple of positional arguments or a dict of
+    keyword arguments. Exactly one of response and error is None. Pending
+    requests are dropped if the caller stops iterating or if task is
+    canceled.
+
+    Called from a request of another runMany, the requests are run one
+    after the other in the calling thread, so that nested batches do not
+    multiply the number of threads.
+
+    :param workers: Number of parallel requests, batchWorkers() if None
+    :type workers: int
+
+    :param task: The task the batch runs in, for cancellation
+    :type task: QgsTask
+    """
+
+    def _call(request):
+        batch = inBatch()
+        _current.batch = True
+        try:
+            if isinstance(request, dict):
+                return runAs(task, function, **request)
+            return runAs(task, function, *request)
+        finally:
+            _current.batch = batch
+
+    if inBatch():
+        yield from _runSequentially(_call, requests, task)
+        return
+    executor = ThreadPoolExecutor(max_workers=workers or batchWorkers())
+    futures = {}
+    try:
+        futures = {
+            executor.submit(_call, request): index
+            for index, request in enumerate(requests)
+        }
+        for future in as_completed(futures):
+            if task is not None and task.isCanceled():
+                break
+            try:
+                yield futures[future], future.result(), None
+            except ValhallaCanceledException:
+                break
+            except Exception as e:
+                yield futures[future], None, e
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _runSequentially(call, requests, task):
+    for index, request in enumerate(requests):
+        if task is not None and task.isCanceled():
+            return
+        try:
+            response = call(request)
+        except ValhallaCanceledException:
+            return
+        except Exception as e:
+            yield index, None, e
+            continue
+        yield index, response, None
+
+
+def checkCanceled():
+    """
+    Raise ValhallaCanceledException if the task running in the calling
+    thread has been canceled. Connectors call it between steps of long
+    requests.
+    """
+    task = currentTask()
+    if task is not None and task.isCanceled():
+        raise ValhallaCanceledException(task.description())
+
+
+class ValhallaTask(QgsTask):
+    """
+    Runs a blocking valhalla request in a background thread.
+
+    responseReady is emitted with the response, or requestFailed with the
+    exception, once the request is done. Both are emitted in the main
+    thread. Neither is emitted if the task is canceled.
+    """
+
+    responseReady = pyqtSignal(object)
+    requestFailed = pyqtSignal(object)
+
+    def __init__(self, description, function, *args, **kwargs):
+        super().__init__(description, QgsTask.CanCancel)
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.response = None
+        self.exception = None
+
+    def run(self):
+        try:
+            self.response = runAs(self, self.function, *self.args, **self.kwargs)
+        except ValhallaCanceledException:
+            return False
+        except Exception as e:
+            self.exception = e
+            return False
+        self.setProgress(100)
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if self.isCanceled():
+            LOG.debug("Task %s canceled" % self.description())
+        elif result:
+            self.responseReady.emit(self.response)
+        else:
+            LOG.error("Task %s failed: %s" % (self.description(), self.exception))
+            self.requestFailed.emit(self.exception)
+
+
+class ValhallaBatchTask(QgsTask):
+    """
+    Runs a batch of blocking valhalla requests in a pool of threads.
+
+    itemFinished is emitted with (index, response, error) for each request
+    as soon as it is done, and the task progress is updated. responses and
+    errors hold all the results, by request index, once the task is done.
+    """
+
+    itemFinished = pyqtSignal(int, object, object)
+
+    def __init__(self, description, function, requests, workers=None):
+        super().__init__(description, QgsTask.CanCancel)
+        self.function = function
+        self.requests = list(requests)
+        self.workers = workers
+        self.responses = {}
+        self.errors = {}
+
+    def run(self):
+        for done, (index, response, error) in enumerate(
+            runMany(self.function, self.requests, self.workers, self), 1
+        ):
+            if error is None:
+                self.responses[index] = response
+            else:
+                self.errors[index] = error
+            self.itemFinished.emit(index, response, error)
+            self.setProgress(100 * done / len(self.requests))
+        return not self.isCanceled()
+
+    def finished(self, result):
+        LOG.info(
+            "Batch %s done: %d responses, %d errors"
+            % (self.description(), len(self.responses), len(self.errors))
+        )
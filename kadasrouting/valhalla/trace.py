@@ -0,0 +1,254 @@
+"""
+Map matching of long traces in chunks.
+
+A trace longer than the trace service limits, or long enough to be worth
+matching in parallel, is split into chunks overlapping by a few hundred
+meters. Each chunk is matched on its own, and the matched routes are
+joined in the middle of each overlap, where both chunks were matched with
+some trace before and after.
+"""
+
+import math
+import logging
+
+from qgis.core import QgsSettings
+
+from kadasrouting.utilities import decodePolyline6, encodePolyline6
+
+from .config import ValhallaConfig
+
+LOG = logging.getLogger(__name__)
+
+# Used until the valhalla configuration has been rendered once
+DEFAULT_MAX_SHAPE = 16000
+DEFAULT_MAX_DISTANCE = 200000.0
+# Length in meters of the chunks matched in parallel, and of their overlap
+DEFAULT_CHUNK_DISTANCE = 20000.0
+CHUNK_OVERLAP_DISTANCE = 500.0
+# Fraction of the service limits used by a chunk, overlap included
+LIMIT_MARGIN = 0.9
+
+START_MANEUVERS = (1, 2, 3)
+DESTINATION_MANEUVERS = (4, 5, 6)
+
+EARTH_RADIUS = 6371008.8
+
+
+def _distance(p1, p2):
+    """Haversine distance in meters between two (lat, lon) tuples"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (p1[0], p1[1], p2[0], p2[1]))
+    h = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, h)))
+
+
+def chunkLimits():
+    """
+    Return the maximum number of points and length in meters of a chunk,
+    within the trace limits of the valhalla configuration
+    """
+    config = ValhallaConfig.getInstance()
+    maxShape = config.serviceLimit("trace", "max_shape", DEFAULT_MAX_SHAPE)
+    maxDistance = config.serviceLimit("trace", "max_distance", DEFAULT_MAX_DISTANCE)
+    chunkDistance = QgsSettings().value(
+        "/kadasrouting/traceChunkDistance", DEFAULT_CHUNK_DISTANCE, type=float
+    )
+    return (
+        max(4, int(maxShape * LIMIT_MARGIN)),
+        min(chunkDistance, maxDistance * LIMIT_MARGIN),
+    )
+
+
+def splitTrace(points, maxPoints, maxDistance, overlap=CHUNK_OVERLAP_DISTANCE):
+    """
+    Split a trace into overlapping chunks.
+
+    :param points: The trace, as (lat, lon) tuples
+    :type points: list
+
+    :returns: (first, last) indices of the points of each chunk, last
+        included. Consecutive chunks overlap, by at least one point.
+    :rtype: list
+    """
+    n = len(points)
+    if n < 2:
+        # nothing to split, matching it fails as for any invalid trace
+        return [(0, max(n - 1, 0))]
+    cumulative = [0.0]
+    for i in range(1, n):
+        cumulative.append(cumulative[-1] + _distance(points[i - 1], points[i]))
+    chunks = []
+    first = 0
+    while True:
+        last = first + 1
+        while (
+            last + 1 < n
+            and last + 1 - first < maxPoints
+            and cumulative[last + 1] - cumulative[first] <= maxDistance
+        ):
+            last += 1
+        chunks.append((first, last))
+        if last == n - 1:
+            return chunks
+        # start the next chunk `overlap` meters before the end of this one
+        following = last - 1
+        while (
+            following > first + 1
+            and cumulative[last] - cumulative[following] < overlap
+            and last - following < maxPoints // 2
+        ):
+            following -= 1
+        first = max(following, first + 1)
+
+
+def cutIndex(chunks, i):
+    """Index of the trace point where chunk i is joined to chunk i + 1"""
+    return (chunks[i + 1][0] + chunks[i][1]) // 2
+
+
+def stitchResponses(responses, points, chunks):
+    """
+    Join the trace_route responses of consecutive chunks into one response.
+
+    :param responses: The response of each chunk, in order
+    :type responses: list
+
+    :param points: The whole trace, as (lat, lon) tuples
+    :type points: list
+
+    :param chunks: The chunks of the trace, as returned by splitTrace
+    :type chunks: list
+
+    :rtype: dict
+    """
+    legs = list(responses[0]["trip"]["legs"])
+    # the leg being joined is kept decoded until it is complete
+    shape = decodePolyline6(legs[-1]["shape"])
+    maneuvers = [dict(m) for m in legs[-1]["maneuvers"]]
+    joined = False
+    for i, response in enumerate(responses[1:]):
+        cut = points[cutIndex(chunks, i)]
+        # the matched shapes are searched for the cut around the overlap only
+        window = _pathLength(points, chunks[i + 1][0], chunks[i][1]) + CHUNK_OVERLAP_DISTANCE
+        nextLegs = response["trip"]["legs"]
+        _joinLegs(shape, maneuvers, nextLegs[0], cut, window)
+        joined = True
+        if len(nextLegs) > 1:
+            legs[-1] = _joinedLeg(legs[-1], shape, maneuvers)
+            legs.extend(nextLegs[1:])
+            shape = decodePolyline6(legs[-1]["shape"])
+            maneuvers = [dict(m) for m in legs[-1]["maneuvers"]]
+            joined = False
+    if joined:
+        legs[-1] = _joinedLeg(legs[-1], shape, maneuvers)
+    trip = dict(responses[0]["trip"])
+    trip["legs"] = legs
+    trip["locations"] = (
+        responses[0]["trip"]["locations"][:1] + responses[-1]["trip"]["locations"][-1:]
+    )
+    trip["summary"] = dict(
+        trip.get("summary", {}),
+        length=sum(leg["summary"]["length"] for leg in legs),
+        time=sum(leg["summary"]["time"] for leg in legs),
+    )
+    return dict(responses[0], trip=trip)
+
+
+def _closestVertex(shape, point, indices):
+    return min(indices, key=lambda i: _distance(shape[i], point))
+
+
+def _joinLegs(shape, maneuvers, leg, cut, window):
+    """
+    Join a matched leg to the shape and maneuvers of the previous one, in
+    place, at the vertices closest to cut, a trace point that both legs were
+    matched from. Only the vertices within window meters of the end of the
+    previous leg and of the start of the next one are searched.
+    """
+    nextShape = decodePolyline6(leg["shape"])
+    # the cut is in the overlap, at the end of shape and the start of nextShape
+    tail = len(shape) - 1
+    travelled = 0.0
+    while tail > 0 and travelled <= window:
+        travelled += _distance(shape[tail - 1], shape[tail])
+        tail -= 1
+    head = 0
+    travelled = 0.0
+    while head < len(nextShape) - 1 and travelled <= window:
+        travelled += _distance(nextShape[head], nextShape[head + 1])
+        head += 1
+    end = _closestVertex(shape, cut, range(len(shape) - 1, tail - 1, -1))
+    start = _closestVertex(nextShape, cut, range(head + 1))
+
+    while maneuvers and (
+        maneuvers[-1]["type"] in DESTINATION_MANEUVERS
+        or (end < len(shape) - 1 and maneuvers[-1]["begin_shape_index"] >= end)
+    ):
+        maneuvers.pop()
+    if maneuvers and maneuvers[-1]["end_shape_index"] > end:
+        maneuvers[-1] = _clipManeuver(maneuvers[-1], shape, 0, end, 0)
+    following = _clipManeuvers(
+        leg["maneuvers"], nextShape, start, len(nextShape) - 1, end - start
+    )
+    if maneuvers and following and following[0]["type"] in START_MANEUVERS:
+        # the vehicle keeps going: the last maneuver of the previous leg
+        # extends over what remains of the start maneuver of the next one
+        extension = following.pop(0)
+        maneuvers[-1]["end_shape_index"] = extension["end_shape_index"]
+        maneuvers[-1]["length"] += extension["length"]
+        maneuvers[-1]["time"] += extension["time"]
+    maneuvers.extend(following)
+    del shape[end + 1:]
+    shape.extend(nextShape[start + 1:])
+
+
+def _joinedLeg(leg, shape, maneuvers):
+    return dict(
+        leg,
+        shape=encodePolyline6(shape),
+        maneuvers=maneuvers,
+        summary=dict(
+            leg.get("summary", {}),
+            length=sum(m["length"] for m in maneuvers),
+            time=sum(m["time"] for m in maneuvers),
+        ),
+    )
+
+
+def _clipManeuvers(maneuvers, shape, first, last, shift):
+    """
+    Keep the maneuvers of a leg between the vertices first and last, with
+    their shape indices shifted by shift. The length and time of the
+    maneuvers cut in two are reduced to the part kept.
+    """
+    kept = []
+    for maneuver in maneuvers:
+        if first > 0 and maneuver["end_shape_index"] <= first:
+            continue
+        if last < len(shape) - 1 and maneuver["begin_shape_index"] >= last:
+            continue
+        kept.append(_clipManeuver(maneuver, shape, first, last, shift))
+    return kept
+
+
+def _clipManeuver(maneuver, shape, first, last, shift):
+    begin = maneuver["begin_shape_index"]
+    end = maneuver["end_shape_index"]
+    clippedBegin = max(begin, first)
+    clippedEnd = min(end, last)
+    maneuver = dict(maneuver)
+    if (clippedBegin, clippedEnd) != (begin, end):
+        fraction = _pathLength(shape, clippedBegin, clippedEnd) / max(
+            _pathLength(shape, begin, end), 1e-9
+        )
+        maneuver["length"] = maneuver["length"] * fraction
+        maneuver["time"] = maneuver["time"] * fraction
+    maneuver["begin_shape_index"] = clippedBegin + shift
+    maneuver["end_shape_index"] = clippedEnd + shift
+    return maneuver
+
+
+def _pathLength(shape, first, last):
+    return sum(_distance(shape[i], shape[i + 1]) for i in range(first, last))
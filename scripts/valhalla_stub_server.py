@@ -0,0 +1,221 @@
+# coding=utf-8
+"""Small stand-in for a valhalla_service running in HTTP mode.
+
+It answers the actions used by the plugin with synthetic, but well formed,
+responses (straight lines between the requested locations), so that the
+HTTP connector can be exercised without Valhalla or map packages:
+
+    python scripts/valhalla_stub_server.py --port 8002
+
+and set /kadasrouting/valhalla_connector to "http" and
+/kadasrouting/valhalla_http_url to "http://127.0.0.1:8002".
+"""
+
+import io
+import json
+import math
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Average speed used to compute durations, in km/h
+SPEED = 50.0
+
+
+def encode_polyline6(coordinates):
+    """Encode a list of (lat, lon) tuples as a polyline6 string"""
+    output = io.StringIO()
+    prev_lat, prev_lon = 0, 0
+    for lat, lon in coordinates:
+        lat, lon = int(round(lat * 1e6)), int(round(lon * 1e6))
+        for value in (lat - prev_lat, lon - prev_lon):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                output.write(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            output.write(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return output.getvalue()
+
+
+def distance_km(a, b):
+    """Haversine distance between two {"lat", "lon"} locations"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (a["lat"], a["lon"], b["lat"], b["lon"]))
+    h = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+
+def leg(a, b):
+    length = distance_km(a, b)
+    time = length / SPEED * 3600
+    return {
+        "shape": encode_polyline6([(a["lat"], a["lon"]), (b["lat"], b["lon"])]),
+        "summary": {"length": length, "time": time},
+        "maneuvers": [
+            {
+                "type": 1,
+                "instruction": "Drive straight.",
+                "begin_shape_index": 0,
+                "end_shape_index": 1,
+                "length": length,
+                "time": time,
+            },
+            {
+                "type": 4,
+                "instruction": "You have arrived at your destination.",
+                "begin_shape_index": 1,
+                "end_shape_index": 1,
+                "length": 0.0,
+                "time": 0.0,
+            },
+        ],
+    }
+
+
+def trip(locations):
+    legs = [leg(a, b) for a, b in zip(locations, locations[1:])]
+    return {
+        "trip": {
+            "locations": locations,
+            "legs": legs,
+            "summary": {
+                "length": sum(lg["summary"]["length"] for lg in legs),
+                "time": sum(lg["summary"]["time"] for lg in legs),
+            },
+            "status": 0,
+            "units": "kilometers",
+        }
+    }
+
+
+def route(request):
+    locations = request["locations"]
+    if len(locations) < 2:
+        raise ValueError("Insufficiently specified required parameter 'locations'")
+    return trip(locations)
+
+
+def optimized_route(request):
+    """Visit the intermediate locations in nearest neighbour order"""
+    locations = [dict(loc, original_index=i) for i, loc in enumerate(request["locations"])]
+    if len(locations) < 2:
+        raise ValueError("Insufficiently specified required parameter 'locations'")
+    ordered, remaining = [locations[0]], locations[1:-1]
+    while remaining:
+        closest = min(remaining, key=lambda loc: distance_km(ordered[-1], loc))
+        remaining.remove(closest)
+        ordered.append(closest)
+    ordered.append(locations[-1])
+    return trip(ordered)
+
+
+def trace_route(request):
+    return trip(request["shape"])
+
+
+def isochrone(request):
+    center = request["locations"][0]
+    features = []
+    for contour in request["contours"]:
+        if "distance" in contour:
+            radius = contour["distance"]
+        else:
+            radius = contour["time"] / 60.0 * SPEED
+        dlat = radius / 111.32
+        dlon = dlat / max(math.cos(math.radians(center["lat"])), 1e-6)
+        ring = [
+            [
+                center["lon"] + dlon * math.cos(math.radians(a)),
+                center["lat"] + dlat * math.sin(math.radians(a)),
+            ]
+            for a in range(0, 361, 10)
+        ]
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [ring]},
+                "properties": {
+                    "contour": contour.get("time", contour.get("distance")),
+                    "color": "#" + contour.get("color", "ff0000"),
+                },
+            }
+        )
+    return {"type": "FeatureCollection", "features": features[::-1]}
+
+
+def sources_to_targets(request):
+    matrix = []
+    for i, source in enumerate(request["sources"]):
+        row = []
+        for j, target in enumerate(request["targets"]):
+            length = distance_km(source, target)
+            row.append(
+                {
+                    "from_index": i,
+                    "to_index": j,
+                    "distance": length,
+                    "time": length / SPEED * 3600,
+                }
+            )
+        matrix.append(row)
+    return {
+        "sources": [request["sources"]],
+        "targets": [request["targets"]],
+        "sources_to_targets": matrix,
+        "units": "kilometers",
+    }
+
+
+ACTIONS = {
+    "route": route,
+    "chinese_postman": route,
+    "optimized_route": optimized_route,
+    "trace_route": trace_route,
+    "isochrone": isochrone,
+    "sources_to_targets": sources_to_targets,
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as the real service
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/status"):
+            self.send_json(200, {"version": "stub"})
+        else:
+            self.send_json(404, {"error_code": 106, "error": "Try any of: " + ", ".join(ACTIONS)})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        action = self.path.strip("/").split("?")[0]
+        if action not in ACTIONS:
+            self.send_json(404, {"error_code": 106, "error": "Try any of: " + ", ".join(ACTIONS)})
+            return
+        try:
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            response = ACTIONS[action](request)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error_code": 100, "error": str(e), "status_code": 400})
+            return
+        self.send_json(200, response)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print("Valhalla stub listening on http://%s:%s" % (args.host, args.port))
+    server.serve_forever()
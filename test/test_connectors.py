@@ -0,0 +1,55 @@
+# coding=utf-8
+"""Tests for the valhalla connectors.
+
+Run them with the python of KADAS or QGIS, from the repository root:
+
+    python -m unittest discover -s test
+"""
+
+import sys
+import time
+import threading
+import unittest
+
+from kadasrouting.exceptions import ValhallaCanceledException
+from kadasrouting.valhalla.connectors import runProcess
+from kadasrouting.valhalla.tasks import runAs
+
+# A command that would run much longer than the test
+LONG_COMMAND = [sys.executable, "-c", "import time; time.sleep(60)"]
+
+
+class FakeTask:
+    """Stands for the ValhallaTask a request runs in"""
+
+    def __init__(self):
+        self.canceled = threading.Event()
+
+    def isCanceled(self):
+        return self.canceled.is_set()
+
+    def description(self):
+        return "fake task"
+
+    def cancel(self):
+        self.canceled.set()
+
+
+class RunProcessTest(unittest.TestCase):
+    def test_output(self):
+        stdout, stderr = runProcess(
+            [sys.executable, "-c", "print('valhalla')"], None
+        )
+        self.assertEqual(stdout.strip(), b"valhalla")
+
+    def test_cancel_long_command(self):
+        task = FakeTask()
+        threading.Timer(0.5, task.cancel).start()
+        start = time.monotonic()
+        with self.assertRaises(ValhallaCanceledException):
+            runAs(task, runProcess, LONG_COMMAND, None)
+        self.assertLess(time.monotonic() - start, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()